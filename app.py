@@ -2,7 +2,22 @@ import re
 import os
 import sys
 import fitz  # PyMuPDF Do not import fitz library
+import numpy as np
 import json
+import time
+import bisect
+import uuid
+from array import array
+import hashlib
+import mmap
+import tempfile
+from collections import OrderedDict, deque
+from itertools import accumulate, repeat
+from operator import add
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import anvil.server
 from dotenv import load_dotenv
 
@@ -18,29 +33,336 @@ else:
     load_dotenv(".env.local")  # Load local development environment variables
     auth_file_path = os.path.join("config", "auth.json")  # Local path to auth file
 
-# Step 3: Handle missing configurations
-if not auth_file_path or not os.path.exists(auth_file_path):
-    raise FileNotFoundError(
-        f"Authentication file not found at {auth_file_path}. Ensure it exists in the expected location."
-    )
 
-# Step 4: Load the authentication key file
-with open(auth_file_path, 'r') as f:
-    key = json.load(f)
+def connect_uplink():
+    """ CONNECT TO THE ANVIL SERVER WITH THE UPLINK KEY FOR THIS ENVIRONMENT """
 
-# Step 5: Determine the uplink key
-uplink_key = key.get("ANVIL_UPLINK_KEY" if live_server else "ANVIL_TEST_KEY")
-if not uplink_key:
-    raise ValueError("Uplink key not found in the authentication file.")
+    # Step 3: Handle missing configurations
+    if not auth_file_path or not os.path.exists(auth_file_path):
+        raise FileNotFoundError(
+            f"Authentication file not found at {auth_file_path}. Ensure it exists in the expected location."
+        )
 
-# Step 6: Connect to the Anvil server
-anvil.server.connect(uplink_key)
+    # Step 4: Load the authentication key file
+    with open(auth_file_path, 'r') as f:
+        key = json.load(f)
 
+    # Step 5: Determine the uplink key
+    uplink_key = key.get("ANVIL_UPLINK_KEY" if live_server else "ANVIL_TEST_KEY")
+    if not uplink_key:
+        raise ValueError("Uplink key not found in the authentication file.")
 
-def sort_key(s):
-    page, lines = s.split(':')
-    start_line, end_line = map(int, lines.split('-'))
-    return int(page), start_line
+    # Step 6: Connect to the Anvil server
+    anvil.server.connect(uplink_key)
+
+
+# Step 7: Worker pool settings for the CPU-heavy callables (a pool size of 0 runs work inline)
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", os.cpu_count() or 1))
+WORKER_QUEUE_LIMIT = int(os.getenv("WORKER_QUEUE_LIMIT", "16"))
+WORKER_QUEUE_TIMEOUT = float(os.getenv("WORKER_QUEUE_TIMEOUT", "30"))
+PARALLEL_PAGE_THRESHOLD = int(os.getenv("PARALLEL_PAGE_THRESHOLD", "100"))  # PDFs with this many highlighted pages are split across workers
+
+
+class WorkerPoolBusyError(Exception):
+    """Raised when every worker is busy and the queue is full."""
+
+
+def run_timed(func, submitted_at, args):
+    """Runs inside a worker process and reports how long the task sat in the queue."""
+    return time.time() - submitted_at, func(*args)
+
+
+class BoundedWorkerPool:
+    """
+    Process pool with a bounded queue for the PyMuPDF and regex heavy callables.
+
+    At most max_workers tasks run at once and at most queue_limit more wait for a free worker.
+    Anything beyond that waits up to queue_timeout seconds for a slot, then is rejected with
+    WorkerPoolBusyError so a burst of uploads degrades gracefully instead of piling up.
+    """
+
+    def __init__(self, max_workers, queue_limit, queue_timeout):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max(max_workers, 1) + queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+
+    def _get_executor(self):
+        # Workers are spawned, not forked: forking this threaded process could copy a lock held by a handler
+        # thread into the child. Spawned workers import this module afresh and never connect the uplink.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _task_done(self, wait, failed, broken=False):
+        self._slots.release()
+        with self._lock:
+            self._in_flight -= 1
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+                self._last_wait = wait
+            if broken:
+                # A crashed worker breaks the whole executor, start a fresh one on the next submit
+                self._executor = None
+
+    def submit(self, func, *args):
+        """Queues func(*args) on the pool and returns a Future for its result."""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._rejected += 1
+            raise WorkerPoolBusyError("The server is busy processing other requests. Please try again shortly.")
+
+        with self._lock:
+            self._in_flight += 1
+
+        result_future = Future()
+        if self.max_workers <= 0:
+            try:
+                result_future.set_result(func(*args))
+            except Exception as e:
+                self._task_done(0.0, True)
+                result_future.set_exception(e)
+            else:
+                self._task_done(0.0, False)
+            return result_future
+
+        def on_done(worker_future):
+            try:
+                wait, result = worker_future.result()
+            except Exception as e:
+                self._task_done(0.0, True, isinstance(e, BrokenProcessPool))
+                result_future.set_exception(e)
+            else:
+                self._task_done(wait, False)
+                result_future.set_result(result)
+
+        try:
+            with self._lock:
+                executor = self._get_executor()
+            worker_future = executor.submit(run_timed, func, time.time(), args)
+        except Exception as e:
+            self._task_done(0.0, True, isinstance(e, BrokenProcessPool))
+            raise
+        worker_future.add_done_callback(on_done)
+        return result_future
+
+    def run(self, func, *args):
+        """Runs func(*args) on the pool and blocks until the result is ready."""
+        return self.submit(func, *args).result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queue_limit": self.queue_limit,
+                "running": min(self._in_flight, self.max_workers),
+                "queue_depth": max(self._in_flight - self.max_workers, 0),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "last_wait_seconds": round(self._last_wait, 3),
+                "max_wait_seconds": round(self._max_wait, 3),
+                "average_wait_seconds": round(self._total_wait / self._completed, 3) if self._completed else 0.0,
+            }
+
+
+worker_pool = BoundedWorkerPool(WORKER_POOL_SIZE, WORKER_QUEUE_LIMIT, WORKER_QUEUE_TIMEOUT)
+
+# Step 8: Result cache settings for repeat uploads (an empty RESULT_CACHE_DIR keeps the cache in memory only)
+EXTRACTOR_VERSION = "4"  # Bump whenever the extraction output changes so stale cache entries are ignored
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024
+RESULT_CACHE_MEMORY_ITEMS = int(os.getenv("RESULT_CACHE_MEMORY_ITEMS", "64"))
+PAGE_CACHE_MEMORY_ITEMS = int(os.getenv("PAGE_CACHE_MEMORY_ITEMS", "4096"))
+
+
+def content_cache_key(data, *parts):
+    """Builds a cache key from a hash of the content plus anything else the result depends on."""
+    return "-".join([hashlib.sha256(data).hexdigest(), *map(str, parts)])
+
+
+class ResultCache:
+    """
+    Two tier cache for extraction results, keyed by content hash.
+
+    The memory tier is an LRU of at most memory_items entries. The disk tier stores one JSON file per
+    key under disk_dir and evicts the least recently used files once they exceed disk_max_bytes, so
+    results survive a container restart.
+    """
+
+    def __init__(self, memory_items, disk_dir, disk_max_bytes):
+        self.memory_items = memory_items
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir)
+                                   if entry.name.endswith(".json"))
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                value = json.load(f)
+            os.utime(self._path(key))  # Mark as recently used for eviction
+        except (OSError, ValueError):
+            return None
+
+        with self._lock:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        if not self.disk_dir:
+            return
+
+        # Write to a scratch file first so a crash never leaves a half written entry behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        size = os.path.getsize(tmp_path)
+        path = self._path(key)
+        with self._lock:
+            if os.path.exists(path):
+                self._disk_bytes -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._disk_bytes += size
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".json")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+
+
+result_cache = ResultCache(RESULT_CACHE_MEMORY_ITEMS, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# Per-page excerpts, keyed by page fingerprint, so a re-upload only re-extracts the pages that changed
+page_cache = ResultCache(PAGE_CACHE_MEMORY_ITEMS, RESULT_CACHE_DIR and os.path.join(RESULT_CACHE_DIR, "pages"),
+                         RESULT_CACHE_MAX_BYTES)
+
+
+# Step 9: Background job settings for long PDF extractions
+JOB_RUNNER_THREADS = int(os.getenv("JOB_RUNNER_THREADS", "4"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "16"))  # Jobs waiting for a runner thread, each holding its PDF
+JOB_PAGES_PER_TASK = int(os.getenv("JOB_PAGES_PER_TASK", "10"))  # Smaller tasks mean finer progress reports
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))  # Seconds a finished job is kept for polling
+
+
+class JobStore:
+    """
+    In-memory record of background PDF jobs and their per-page progress.
+
+    Finished jobs (done or failed) are dropped result_ttl seconds after they finish; jobs that are
+    still running never expire.
+    """
+
+    def __init__(self, result_ttl):
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < cutoff]:
+            del self._jobs[job_id]
+
+    def create(self, file_name):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._expire()
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'file_name': file_name,
+                'state': "queued",
+                'pages_done': 0,
+                'pages_total': None,
+                'error': None,
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'excerpts': [],
+            }
+        return job_id
+
+    def _job(self, job_id):
+        self._expire()
+        if job_id not in self._jobs:
+            raise KeyError(f"Unknown or expired job: {job_id}")
+        return self._jobs[job_id]
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+                if fields.get('state') in ("done", "failed"):
+                    self._jobs[job_id]['finished_at'] = time.time()
+
+    def add_excerpts(self, job_id, excerpts, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id]['excerpts'].extend(excerpts)
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        """Returns the job's status fields, with a count of the excerpts ready so far instead of the excerpts."""
+        with self._lock:
+            job = dict(self._job(job_id))
+        job['excerpts_ready'] = len(job.pop('excerpts'))
+        return job
+
+    def get_excerpts(self, job_id, offset=0, limit=None):
+        with self._lock:
+            excerpts = self._job(job_id)['excerpts']
+            return excerpts[offset:None if limit is None else offset + limit]
+
+
+job_store = JobStore(JOB_RESULT_TTL)
+job_runner = ThreadPoolExecutor(max_workers=JOB_RUNNER_THREADS, thread_name_prefix="pdf-job")
+job_slots = threading.BoundedSemaphore(JOB_RUNNER_THREADS + JOB_QUEUE_LIMIT)  # Running plus queued jobs
 
 
 @anvil.server.callable()
@@ -62,27 +384,108 @@ def setup_variables():
 @anvil.server.callable
 def process_pdf_locally(file):
     # Here, 'file' is the Media object sent from Anvil
-    # You can read its content and process it as needed
-    with open("temp_pdf.pdf", "wb") as f:
-        f.write(file.get_bytes())
+    # The bytes are opened as an in-memory stream, so concurrent uploads never share a scratch file
+    pdf_bytes = file.get_bytes()
 
-    with open("temp_pdf.pdf", "rb") as f:
-        text_display = extract_highlighted_text_with_coordinates(f)
-        return "".join(text_display)
+    # Repeat uploads of the same PDF are served from the result cache
+    cache_key = content_cache_key(pdf_bytes, "highlights", EXTRACTOR_VERSION)
+    text_display = result_cache.get(cache_key)
+    if text_display is None:
+        text_display = extract_highlighted_text_in_parallel(pdf_bytes)
+        result_cache.put(cache_key, text_display)
+    return "".join(text_display)
 
 
 @anvil.server.callable
 def process_pdf(file):
     # This function will be called from the client code with the uploaded file
-    # Now, send this file to the local script
+    # It already runs inside this uplink, so the file is processed in-process rather than
+    # bounced back through the Anvil server with anvil.server.call
     print(f"File name: {file.name}")
     print(f"Content type: {file.content_type}")
-    # Get the file content
-    file_content = file.get_bytes()
 
-    # Check the size of the file content
-    print(f"File size: {len(file_content)} bytes")
-    return anvil.server.call('process_pdf_locally', file)
+    # The size comes from the Media metadata, so the bytes are only transferred once
+    print(f"File size: {file.length} bytes")
+    return process_pdf_locally(file)
+
+
+def run_pdf_job(job_id, pdf_bytes, page_range=None):
+    """ BACKGROUND PDF EXTRACTION THAT PUBLISHES EXCERPTS TO THE JOB STORE PAGE BY PAGE """
+
+    job_store.update(job_id, state="running")
+    try:
+        # Cached with the page count, so a repeat job reports the same progress as the first one
+        cache_key = content_cache_key(pdf_bytes, "highlight-job", EXTRACTOR_VERSION, page_range)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            job_store.add_excerpts(job_id, cached['excerpts'], pages_done=cached['pages_total'],
+                                   pages_total=cached['pages_total'])
+        else:
+            # A PDF without highlights yields no pages at all
+            job_store.update(job_id, pages_done=0, pages_total=0)
+            for page_num, texts, pages_done, pages_total in iter_highlighted_pages(pdf_bytes, JOB_PAGES_PER_TASK,
+                                                                                    page_range):
+                job_store.add_excerpts(job_id, texts, pages_done=pages_done, pages_total=pages_total)
+            result_cache.put(cache_key, {'excerpts': job_store.get_excerpts(job_id),
+                                         'pages_total': job_store.get(job_id)['pages_total']})
+    except Exception as e:
+        job_store.update(job_id, state="failed", error=str(e))
+    else:
+        job_store.update(job_id, state="done")
+
+
+@anvil.server.callable
+def submit_pdf_job(file, page_range=None):
+    # Starts extraction in the background and returns straight away, so no upload is capped by the call timeout.
+    # page_range = (first, last) restricts extraction to the pages the user is looking at
+    # Queued jobs keep their whole PDF in memory, so past the queue limit new jobs are turned away
+    if not job_slots.acquire(blocking=False):
+        raise WorkerPoolBusyError("Too many PDF jobs are waiting. Please try again shortly.")
+    try:
+        job_id = job_store.create(file.name)
+        future = job_runner.submit(run_pdf_job, job_id, file.get_bytes(), tuple(page_range) if page_range else None)
+    except Exception:
+        job_slots.release()
+        raise
+    future.add_done_callback(lambda future: job_slots.release())
+    return job_id
+
+
+@anvil.server.callable
+def get_job_status(job_id):
+    # Poll this for state ("queued", "running", "done" or "failed") and per-page progress
+    return job_store.get(job_id)
+
+
+@anvil.server.callable
+def get_highlights(job_id, offset=0, limit=50):
+    # Serves the excerpts found so far a page at a time, while the job is still running
+    job = job_store.get(job_id)
+    if job['state'] == "failed":
+        raise RuntimeError(f"PDF job failed: {job['error']}")
+    items = job_store.get_excerpts(job_id, offset, limit)
+    return {
+        'items': items,
+        'next_offset': offset + len(items),
+        'done': job['state'] == "done" and offset + len(items) >= job['excerpts_ready'],
+    }
+
+
+@anvil.server.callable
+def get_job_result(job_id):
+    # Returns the extracted text once the job is done, None while it is still running
+    job = job_store.get(job_id)
+    if job['state'] == "failed":
+        raise RuntimeError(f"PDF job failed: {job['error']}")
+    if job['state'] != "done":
+        return None
+    return "".join(job_store.get_excerpts(job_id))
+
+
+@anvil.server.callable
+def get_worker_pool_stats():
+    # Queue depth and wait times for the worker pool that runs the PDF and text callables
+    return worker_pool.stats()
 
 
 @anvil.server.callable
@@ -94,23 +497,177 @@ def delete_temp_file(file_path):
         return "File does not exist"
 
 
-def extract_highlighted_text_with_coordinates(file: object) -> object:
-    """ EXTRACT TEXT FROM PDF """
+def open_pdf_document(source):
+    """ OPEN PDF FROM BYTES (IN MEMORY) OR FROM A PATH / FILE OBJECT """
 
-    highlighted_texts = []
-    citations = []
-    doc = fitz.open(file)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
 
+
+XREF_REFERENCE_PATTERN = re.compile(r'(?<!\d)(\d+)\s+\d+\s+R')  # Starts only at the first digit of a number
+
+
+def parse_xref_list(value):
+    """ PULL THE OBJECT NUMBERS OUT OF A PDF REFERENCE OR ARRAY OF REFERENCES ("12 0 R" / "[12 0 R 13 0 R]") """
+
+    return [int(xref) for xref in XREF_REFERENCE_PATTERN.findall(value)]
+
+
+def build_highlight_annotation_index(doc):
+    """ MAP PAGE NUMBER -> HIGHLIGHT ANNOTATION XREFS, READ FROM THE PAGE OBJECTS WITHOUT LOADING ANY PAGE """
+
+    annotation_index = {}
     for page_num in range(len(doc)):
+        kind, value = doc.xref_get_key(doc.page_xref(page_num), "Annots")
+        if kind == "null":
+            continue
+        if kind == "xref":
+            # The /Annots array is stored as its own object
+            value = doc.xref_object(int(value.split()[0]), compressed=True)
+
+        annot_xrefs = parse_xref_list(value)
+        highlight_xrefs = [xref for xref in annot_xrefs if doc.xref_get_key(xref, "Subtype") == ("name", "/Highlight")]
+        if highlight_xrefs:
+            annotation_index[page_num] = highlight_xrefs
+    return annotation_index
+
+
+def highlighted_page_fingerprint(doc, page_num, highlight_xrefs):
+    """ FINGERPRINT A PAGE'S CONTENT STREAM AND HIGHLIGHT SET (TYPE, RECT, COLOUR, MODIFICATION DATE) """
+
+    fingerprint = [str(page_num)]
+    kind, contents = doc.xref_get_key(doc.page_xref(page_num), "Contents")
+    content_digest = hashlib.sha256()
+    for xref in parse_xref_list(contents):
+        content_digest.update(doc.xref_stream_raw(xref) or b"")
+    fingerprint.append(content_digest.hexdigest())
+
+    for xref in highlight_xrefs:
+        fingerprint.extend(repr(doc.xref_get_key(xref, key)) for key in ("Subtype", "Rect", "QuadPoints", "C", "M"))
+    return "\n".join(fingerprint).encode()
+
+
+def split_into_shards(items, shard_count):
+    """ SPLIT A LIST (E.G. PAGE NUMBERS) INTO CONTIGUOUS, EVENLY SIZED SHARDS """
+
+    shard_size, remainder = divmod(len(items), shard_count)
+    shards = []
+    start = 0
+    for i in range(shard_count):
+        end = start + shard_size + (1 if i < remainder else 0)
+        if end > start:
+            shards.append(items[start:end])
+        start = end
+    return shards
+
+
+def extract_highlighted_text_in_parallel(pdf_bytes):
+    """ EXTRACT TEXT FROM PDF, SHARDING LONG DOCUMENTS ACROSS THE WORKER POOL """
+
+    return [text for page_num, texts, pages_done, pages_total in iter_highlighted_pages(pdf_bytes)
+            for text in texts]
+
+
+def iter_highlighted_pages(pdf_bytes, pages_per_task=None, page_range=None):
+    """
+    YIELD (PAGE NUMBER, EXCERPTS, PAGES DONE, PAGES TOTAL) FOR EVERY HIGHLIGHTED PAGE, IN PAGE ORDER
+
+    Each page is yielded as soon as it and every page before it are ready. pages_per_task fixes the shard
+    size instead of splitting the pages evenly across the workers, and page_range = (first, last) limits
+    extraction to those PDF page numbers (1-based, inclusive, either end may be None). These are the
+    numbers a PDF viewer and the "Pg. N:" excerpt headers use, not the page numbers printed on a transcript.
+    """
+
+    with open_pdf_document(pdf_bytes) as doc:
+        annotation_index = build_highlight_annotation_index(doc)
+        if page_range is not None:
+            first_page, last_page = page_range
+            annotation_index = {page_num: xrefs for page_num, xrefs in annotation_index.items()
+                                if (first_page is None or page_num + 1 >= first_page)
+                                and (last_page is None or page_num + 1 <= last_page)}
+        page_keys = {page_num: content_cache_key(highlighted_page_fingerprint(doc, page_num, xrefs),
+                                                 "page", EXTRACTOR_VERSION)
+                     for page_num, xrefs in annotation_index.items()}
+
+    # Pages whose content and highlights are unchanged since an earlier upload reuse their cached excerpts
+    page_texts = {}
+    for page_num, page_key in page_keys.items():
+        cached_texts = page_cache.get(page_key)
+        if cached_texts is not None:
+            page_texts[page_num] = cached_texts
+    changed_pages = sorted(page_num for page_num in page_keys if page_num not in page_texts)
+
+    if pages_per_task:
+        shards = [changed_pages[i:i + pages_per_task] for i in range(0, len(changed_pages), pages_per_task)]
+    elif len(changed_pages) < PARALLEL_PAGE_THRESHOLD or worker_pool.max_workers <= 1:
+        shards = split_into_shards(changed_pages, 1)
+    else:
+        shards = split_into_shards(changed_pages, worker_pool.max_workers)
+
+    all_pages = sorted(page_keys)
+    pages_done = 0
+
+    def ready_pages():
+        # Every page that is ready and has no unfinished page before it
+        nonlocal pages_done
+        while pages_done < len(all_pages) and all_pages[pages_done] in page_texts:
+            page_num = all_pages[pages_done]
+            pages_done += 1
+            yield page_num, page_texts.pop(page_num), pages_done, len(all_pages)
+
+    def collect(future):
+        for page_num, texts in future.result().items():
+            page_cache.put(page_keys[page_num], texts)
+            page_texts[page_num] = texts
+
+    yield from ready_pages()
+
+    # Each worker opens its own document handle on its page range, results are merged back in page order.
+    # Only one shard per worker is queued at a time so a long document never floods the pool queue.
+    pending = deque()
+    for shard in shards:
+        if len(pending) >= max(worker_pool.max_workers, 1):
+            collect(pending.popleft())
+            yield from ready_pages()
+        pending.append(worker_pool.submit(extract_highlighted_pages, pdf_bytes, shard))
+    while pending:
+        collect(pending.popleft())
+        yield from ready_pages()
+
+
+def extract_highlighted_text_with_coordinates(file: object, page_numbers=None) -> object:
+    """ EXTRACT TEXT FROM PDF (OPTIONALLY ONLY THE GIVEN PAGE NUMBERS) """
+
+    page_texts = extract_highlighted_pages(file, page_numbers)
+    return [text for page_num in sorted(page_texts) for text in page_texts[page_num]]
+
+
+def extract_highlighted_pages(file, page_numbers=None):
+    """ EXTRACT TEXT FROM PDF AS {PAGE NUMBER: [EXCERPTS]} """
+
+    page_texts = {}
+    citations = []
+    doc = open_pdf_document(file)
+
+    if page_numbers is None:
+        # Only pages that carry highlight annotations are loaded
+        page_numbers = sorted(build_highlight_annotation_index(doc))
+
+    for page_num in page_numbers:
         page = doc.load_page(page_num)
         annotations = page.annots()
+        page_rows = None
+        highlighted_texts = page_texts.setdefault(page_num, [])
 
         if annotations is not None:
             annotations_found = True
             for annot in annotations:
                 if annot.type[0] == 8:  # Check if the annotation is a highlight
-                    rect = annot.rect
-                    highlighted_text = page.get_text("text", clip=rect)
+                    # The page text is extracted once, then every highlight is resolved against it
+                    if page_rows is None:
+                        page_rows = build_page_row_index(page)
+                    highlighted_text = resolve_highlight_text(page_rows, annot.vertices or [annot.rect.tl, annot.rect.br])
 
                     # Call the function and store the result
                     result = process_pdf_highlighted_text(page_num, highlighted_text)
@@ -128,186 +685,1244 @@ def extract_highlighted_text_with_coordinates(file: object) -> object:
                     citations.append(line_range_info)
 
     doc.close()
-    return highlighted_texts
+    return page_texts
+
+
+def build_page_row_index(page):
+    """ GROUP THE WORDS OF A PAGE INTO VISUAL ROWS, SPLITTING OFF THE LINE NUMBER COLUMN """
+
+    rows = []
+    words = sorted(page.get_text("words"), key=lambda w: ((w[1] + w[3]) / 2, w[0]))
+    for x0, y0, x1, y1, word, *_ in words:
+        y_mid = (y0 + y1) / 2
+        if rows and y_mid - rows[-1]['y_mid'] <= (y1 - y0) / 2:
+            row = rows[-1]
+        else:
+            row = {'y_mid': y_mid, 'line_number': None, 'words': []}
+            rows.append(row)
+        row['words'].append((x0, x1, word))
+
+    line_number_margin = page.rect.x0 + page.rect.width / 4
+    for row in rows:
+        row['words'].sort()
+        x0, x1, word = row['words'][0]
+        # A short number in the left margin is the transcript line number for the row
+        if word.isdigit() and len(word) <= 2 and x0 < line_number_margin:
+            row['line_number'] = int(word)
+            row['words'] = row['words'][1:]
+
+    return rows
+
+
+def printed_page_number(page_rows):
+    """ THE PAGE NUMBER PRINTED AT THE END OF A PAGE'S FIRST ROW (ITS HEADER), OR None """
+
+    if not page_rows or page_rows[0]['line_number'] is not None:
+        return None
+    match = PRINTED_PAGE_NUMBER_PATTERN.search(" ".join(word for x0, x1, word in page_rows[0]['words']))
+    return int(match.group()) if match else None
+
+
+def transcript_pdf_text(pdf_bytes):
+    """
+    REBUILD A TRANSCRIPT PDF AS "Pg. N" HEADERS AND "LINE TEXT" ROWS, THE FORMAT THE TEXT PARSER READS
+
+    N is the page number printed on the page, the one designations refer to. Pages without one (cover
+    pages, exhibits) are left out, like in process_pdf_vector_highlights.
+    """
+
+    cache_key = content_cache_key(pdf_bytes, "transcript-text", EXTRACTOR_VERSION)
+    text = result_cache.get(cache_key)
+    if text is None:
+        lines = []
+        with open_pdf_document(pdf_bytes) as doc:
+            for page in doc:
+                page_rows = build_page_row_index(page)
+                page_number = printed_page_number(page_rows)
+                if page_number is None:
+                    continue
+                lines.append(f"Pg. {page_number}")
+                # A blank line keeps its bare line number, without a trailing space
+                lines.extend(" ".join((str(row['line_number']), *(word for x0, x1, word in row['words'])))
+                             for row in page_rows if row['line_number'] is not None)
+        text = "\n".join(lines)
+        result_cache.put(cache_key, text)
+    return text
+
+
+def resolve_highlight_text(page_rows, vertices):
+    """ COLLECT THE WORDS COVERED BY A HIGHLIGHT'S QUADS, ROW BY ROW """
+
+    row_centers = [row['y_mid'] for row in page_rows]
+    selected = {}
+
+    # Quad points come in groups of four corners, one quad per highlighted line segment
+    for i in range(0, len(vertices) - 1, 4):
+        quad = vertices[i:i + 4]
+        qx0, qx1 = min(x for x, y in quad), max(x for x, y in quad)
+        qy0, qy1 = min(y for x, y in quad), max(y for x, y in quad)
+
+        for row_index in range(bisect.bisect_left(row_centers, qy0), bisect.bisect_right(row_centers, qy1)):
+            hits = selected.setdefault(row_index, set())
+            for word_index, (x0, x1, word) in enumerate(page_rows[row_index]['words']):
+                if qx0 <= (x0 + x1) / 2 <= qx1:
+                    hits.add(word_index)
+
+    text_lines = []
+    for row_index in sorted(selected):
+        row = page_rows[row_index]
+        row_text = " ".join(row['words'][i][2] for i in sorted(selected[row_index]))
+        if row['line_number'] is None and row_text.isdigit():
+            # A bare number outside the line number column is the page number in the header
+            continue
+        if row['line_number'] is not None:
+            # Line numbers go on their own line, the layout process_pdf_highlighted_text expects
+            text_lines.append(str(row['line_number']))
+        text_lines.append(row_text)
+
+    # A trailing newline, like the clipped page text this replaces, so excerpts still end "...\n ---"
+    return "\n".join(text_lines) + "\n"
 
 
 def process_pdf_highlighted_text(page_num, text):
     """ PREPARE TEXT THAT HAS BEEN EXTRACTED FROM PDF """
 
-    excerpt_dict = {}
-    processed_text = []
-    first_line_number = None
-    last_line_number = None
-    lines = text.split('\n')
+    # Parsed without the transcript cache, highlights are small and rarely seen twice
+    return render_pdf_excerpt(parse_transcript(text), page_num)
+
+
+# Vector highlights: passages marked with filled shapes drawn on the page instead of highlight annotations
+VECTOR_HIGHLIGHT_PALETTE = (
+    ((1.0, 1.0, 0.0), "Yellow"),
+    ((1.0, 0.8, 0.6), "Light Orange"),
+    ((1.0, 0.0, 0.0), "Red"),
+    ((0.0, 1.0, 0.0), "Green"),
+    ((0.0, 0.0, 1.0), "Blue"),
+    ((0.5, 0.0, 0.5), "Purple"),
+    ((0.0, 1.0, 1.0), "Cyan"),
+    ((1.0, 0.0, 1.0), "Magenta"),
+    ((1.0, 0.647, 0.0), "Orange"),
+    ((0.545, 0.0, 0.545), "Dark Purple"),
+    ((0.0, 0.0, 0.0), "Black"),
+    ((1.0, 1.0, 1.0), "White"),
+    ((0.5, 0.5, 0.5), "Gray"),
+    ((0.859, 0.718, 1.0), "Purple"),  # #DBB7FF
+    ((0.804, 1.0, 1.0), "Light Blue"),  # #CDFFFF
+    ((0.8, 1.0, 1.0), "Light Blue"),  # #CCFFFF
+    ((0.988, 0.6, 0.6), "Light Orange"),  # #FC9
+    ((1.0, 1.0, 0.5098), "Yellow"),  # #FFFF82
+)
+VECTOR_LINE_NUMBER_PATTERN = re.compile(r'(\d{1,9})\s*(Q\.|A\.)?')  # A line number alone, maybe with "Q." / "A."
+PRINTED_PAGE_NUMBER_PATTERN = re.compile(r'(?<!\d)\d{1,9}$')
+
+
+COLOR_LUT_LEVELS = int(os.getenv("COLOR_LUT_LEVELS", "64"))  # Steps per channel in the colour lookup table
+
+
+class ColorPalette:
+    """
+    Nearest-colour classifier for fill colours, built once per palette.
+
+    entries is a sequence of ((r, g, b), name) with channels from 0 to 1, and several entries may share
+    a name. On first use every colour of a levels^3 grid is matched to its nearest entry in one NumPy
+    step. After that, classifying a page's fills is one quantize-and-lookup, with no distances computed.
+    """
 
-    for i, line in enumerate(lines):
-        # Match a line number at the beginning of a line
-        match = re.match(r'^(\d+)\s*$', line)
-        if match:
-            line_number = int(match.group(1))
+    def __init__(self, entries, levels=None):
+        self.entries = [(tuple(float(channel) for channel in rgb), name) for rgb, name in entries]
+        self.levels = levels or COLOR_LUT_LEVELS
+        self.names = sorted({name for rgb, name in self.entries})
+        self.fingerprint = hashlib.sha256(json.dumps([self.entries, self.levels]).encode()).hexdigest()[:16]
+        self._lut = None
 
-            # Track the first and last line numbers
-            if first_line_number is None:
-                first_line_number = line_number
-            last_line_number = line_number
+    @classmethod
+    def from_hex(cls, colors):
+        """ BUILD A PALETTE FROM {"#RRGGBB": NAME}, THE FORMAT USED IN THE RULE PROFILE FILE """
 
-            # Append line number with the subsequent line of text
-            if i + 1 < len(lines):
-                combined_line = f"{line_number} {lines[i + 1]}"
-                processed_text.append(combined_line)
-        elif i == 0 or not re.match(r'^\d+\s*$', lines[i - 1]):
-            # Include lines that are not immediately after a line number
-            processed_text.append(line)
+        entries = []
+        for hex_color, name in colors.items():
+            hex_color = hex_color.lstrip("#")
+            if len(hex_color) == 3:
+                hex_color = "".join(digit * 2 for digit in hex_color)
+            entries.append((tuple(int(hex_color[i:i + 2], 16) / 255 for i in (0, 2, 4)), name))
+        return cls(entries)
 
-    # Format the line range and page information
-    line_range_info = f"{page_num + 1}:{first_line_number}-{last_line_number}" if (first_line_number and
-                                                                                   last_line_number) else f"{page_num + 1}"
+    def _build_lut(self):
+        palette = np.array([rgb for rgb, name in self.entries], dtype=np.float32)
+        name_index = np.array([self.names.index(name) for rgb, name in self.entries], dtype=np.int16)
+        steps = np.linspace(0, 1, self.levels, dtype=np.float32)
+        # Squared distance is a sum over channels, so it is built from three per-channel tables
+        per_channel = [(steps[:, None] - palette[None, :, channel]) ** 2 for channel in range(3)]
+        distances = (per_channel[0][:, None, None, :] + per_channel[1][None, :, None, :] +
+                     per_channel[2][None, None, :, :])
+        return name_index[distances.argmin(axis=3).reshape(-1)]
 
-    excerpt_dict.update({line_range_info: '\n'.join(processed_text)})
+    def classify(self, fills):
+        """ INDEX INTO self.names OF THE NEAREST PALETTE COLOUR FOR EACH ROW OF AN (N, 3) ARRAY OF FILLS """
 
-    return excerpt_dict
+        if self._lut is None:
+            self._lut = self._build_lut()
+        cells = np.clip(np.rint(np.asarray(fills, dtype=float) * (self.levels - 1)), 0, self.levels - 1).astype(int)
+        return self._lut[(cells[:, 0] * self.levels + cells[:, 1]) * self.levels + cells[:, 2]]
 
 
-@anvil.server.callable()
-def prepare_text_for_powerpoint(text, name_checkbox_state, obj_checkbox_state,
-                                detect_pages_checkbox_state, witness_name_checkbox_state, witness_name_text):
+default_color_palette = ColorPalette(VECTOR_HIGHLIGHT_PALETTE)
+
 
+def rect_overlap_matrix(rects, boxes):
     """
-    Processes transcript text to prepare it for PowerPoint output.
+    (len(rects), len(boxes)) boolean matrix of which rects touch or overlap which boxes.
+
+    Both are (N, 4) arrays of x0, y0, x1, y1. Any overlap at all counts, a highlight shape is often
+    drawn slightly off the text line.
     """
-    def clean_line(line):
-        """Cleans and replaces special characters in a line."""
-        # Strip whitespace and replace middle dots
-        line = line.strip().replace('·', ' ')
 
-        # Replace specific phrases using the swap dictionary
-        for word, replacement in swap_phrase_dict.items():
-            line = line.replace(word, replacement)
+    rects, boxes = rects[:, None, :], boxes[None, :, :]
+    return ~((rects[..., 2] < boxes[..., 0]) | (boxes[..., 2] < rects[..., 0]) |
+             (rects[..., 3] < boxes[..., 1]) | (boxes[..., 3] < rects[..., 1]))
 
-        # Remove timestamps at the end of the line
-        line = remove_timestamps(line)
 
-        # Handle lines starting with special characters
-        if line and not line[0].isalnum() and not any(
-                line.startswith(phrase) for phrase in qa_phrases + objection_phrases + non_party_phrases):
-            line = re.sub(r'^[^\w\s]', '', line)
+def extract_vector_text_boxes(text_dict):
+    """
+    Reads the printed page number and the numbered text lines from a page's get_text("dict") output.
 
-        # Handle lines that start with "Pg. "
-        if line.startswith("Pg. "):
-            line = "\n\n" + line
+    Returns (page number, [(bbox, line number)]). Line numbers sit on their own line in the text layer,
+    so each one is carried to the text line that follows it.
+    """
 
-        return line
+    page_number = None
+    text_boxes = []
+    line_number = None
+    for block in text_dict['blocks']:
+        if block['type'] != 0:  # Not a text block
+            continue
+        for line in block['lines']:
+            line_text = "".join(span['text'] for span in line['spans']).strip()
+            if page_number is None and not text_boxes and line_number is None:
+                # The first line of the page carries the printed page number
+                match = PRINTED_PAGE_NUMBER_PATTERN.search(line_text)
+                page_number = int(match.group()) if match else None
+            if VECTOR_LINE_NUMBER_PATTERN.fullmatch(line_text):
+                line_number = int(VECTOR_LINE_NUMBER_PATTERN.fullmatch(line_text).group(1))
+                continue
+            text_boxes.append((tuple(line['bbox']), line_number))
+            line_number = None
+    return page_number, text_boxes
+
+
+def scan_vector_highlight_page(page, palette=None):
+    """ ONE PASS OVER A PAGE: ITS PRINTED PAGE NUMBER, FILL COLOUR COUNTS AND {COLOUR: LINE NUMBERS COVERED} """
+
+    palette = palette or default_color_palette
+
+    filled = [drawing for drawing in page.get_drawings() if drawing['fill'] is not None]
+    if not filled:
+        # Nothing drawn, so the text layer is never read
+        return None, {}, {}
+
+    page_number, text_boxes = extract_vector_text_boxes(page.get_text("dict"))
+    color_ids = palette.classify([drawing['fill'] for drawing in filled])
+    counts = np.bincount(color_ids, minlength=len(palette.names))
+    color_counts = {palette.names[i]: int(count) for i, count in enumerate(counts) if count}
+
+    numbered_boxes = [(bbox, line_number) for bbox, line_number in text_boxes if line_number is not None]
+    if not numbered_boxes:
+        return page_number, color_counts, {}
+
+    # (shape x line) hits, then (colour x line) by summing the hits of each colour's shapes
+    hit_matrix = rect_overlap_matrix(np.array([tuple(drawing['rect']) for drawing in filled], dtype=float),
+                                     np.array([bbox for bbox, line_number in numbered_boxes], dtype=float))
+    color_matrix = np.zeros((len(palette.names), len(filled)), dtype=np.int32)
+    color_matrix[color_ids, np.arange(len(filled))] = 1
+    color_hits = color_matrix @ hit_matrix.astype(np.int32) > 0
+
+    line_numbers = np.array([line_number for bbox, line_number in numbered_boxes])
+    hits = {palette.names[i]: set(line_numbers[color_hits[i]].tolist())
+            for i in np.flatnonzero(color_hits.any(axis=1))}
+    return page_number, color_counts, hits
+
+
+def detect_vector_highlights(pdf_bytes, profile_name=None):
+    """
+    Finds the transcript lines covered by filled shapes, per colour, opening the PDF once. Colours are
+    named with the rule profile's palette.
 
-    def remove_timestamps(line):
-        """Removes timestamps in the format XX:XX:XX from the end of the line."""
-        return re.sub(r'[\s\t]*\b\d{2}:\d{2}:\d{2}$', '', line).strip()
+    Returns {"colors": {colour: shape count}, "ranges": {colour: ["12:3-9", "12:20-13:4", ...]}}. Pages
+    without a printed page number are counted but not mapped to lines.
+    """
 
+    palette = rule_profiles.get(profile_name).palette
+    color_counts = {}
+    lines_by_color = {}
+    with open_pdf_document(pdf_bytes) as doc:
+        for page in doc:
+            page_number, page_counts, hits = scan_vector_highlight_page(page, palette)
+            for color_name, count in page_counts.items():
+                color_counts[color_name] = color_counts.get(color_name, 0) + count
+            if page_number is None:
+                continue
+            for color_name, line_numbers in hits.items():
+                lines_by_color.setdefault(color_name, set()).update((page_number, line_number)
+                                                                    for line_number in line_numbers)
+
+    ranges = {}
+    for color_name, lines in lines_by_color.items():
+        # One unmarked line between two marked lines on a page is taken as marked, the box just missed it
+        designations = [(page, line_no, page, line_no + 2 if (page, line_no + 2) in lines else line_no)
+                        for page, line_no in lines]
+        ranges[color_name] = [format_designation(designation) for designation in coalesce_designations(designations)]
+    return {"colors": color_counts, "ranges": ranges}
 
-    def process_line_groups(phrase, capitalize_flag):
-        """Adds a processed phrase to the completed groups, with optional capitalization."""
-        if phrase:
-            return phrase.upper() if capitalize_flag else phrase
-        return None
 
-    # Configuration and state variables
-    qa_phrases = ["Q.", "A.", "Q ", "A ", "Q: ", "A: "]
-    objection_phrases = ["MR ", "MRS ", "MS ", "ATTY ", "ATTORNEY ", "MR. ", "MRS. ", "MS. ", "ATTY. "]
-    non_party_phrases = ["THE VIDEOGRAPHER", "THE COURT"]
-    swap_phrase_dict = {"THE WITNESS:": "A."}
-    completed_line_groups = []
-    capitalize = False
-    phrase_being_assembled = ""
-    
-    
-    print(text)
-    # Replace all middle dots '·' with spaces
-    # text = text.replace('·', ' ')
-    lines = text.split('\n')  # split lines into a list based on hard returns
-    first_num = None  # set up variables to keep track of line number range
-    last_num = None  # set up variables to keep track of line number range
-
-    # qa_phrases = ["Q.", "A.", "Q ", "A ", "Q: ", "A: "]  # phrases or words that will impact when line breaks occur -
-    # Qs
-    # and As
-    # objection_phrases = ["MR ", "MRS ", "MS ", "ATTY ",
-    #                      "ATTORNEY ", "MR. ", "MRS. ", "MS. ",
-    #                      "ATTY. "]  # phrases or words that affect capitalization and are flagged for removal
-    # non_party_phrases = [
-    #     "THE VIDEOGRAPHER", "THE COURT"]  # phrases or words that are not objections that affect caps for removal
-    # completed_line_groups = []  # Used to create larger lines that are combined based on common attributes (all
-    # part of an objection, etc)
-    # phrase_being_assembled = ""
-    # capitalize = False
-    # swap_phrase_dict = {"THE WITNESS:": "A."}
-
-    # hide_names = name_checkbox_state
-    # hide_objections = obj_checkbox_state
-    # show_witness_names = witness_name_checkbox_state
-    # detect_pages = detect_pages_checkbox_state
+@anvil.server.callable
+def process_pdf_vector_highlights(file, profile=None):
+    # For PDFs marked up with drawn shapes rather than highlight annotations, returns the line ranges per colour
+    pdf_bytes = file.get_bytes()
+    palette = rule_profiles.get(profile).palette
+    cache_key = content_cache_key(pdf_bytes, "vector-highlights", EXTRACTOR_VERSION, palette.fingerprint)
+    result = result_cache.get(cache_key)
+    if result is None:
+        result = worker_pool.run(detect_vector_highlights, pdf_bytes, profile)
+        result_cache.put(cache_key, result)
+    return result
+
+
+# Speaker rules for the transcript cleaner
+QA_PHRASES = ["Q.", "A.", "Q ", "A ", "Q: ", "A: "]
+OBJECTION_PHRASES = ["MR ", "MRS ", "MS ", "ATTY ", "ATTORNEY ", "MR. ", "MRS. ", "MS. ", "ATTY. "]
+NON_PARTY_PHRASES = ["THE VIDEOGRAPHER", "THE COURT"]
+SWAP_PHRASE_DICT = {"THE WITNESS:": "A."}
+
+# Whole-buffer cleanup, applied to every line at once before the per-line parse. These patterns run on pasted
+# text, so keep them linear: no quantifier may be followed by another that can match the same characters.
+TEXT_TRANSLATION_TABLE = str.maketrans({
+    '·': ' ',        # Middle dot
+    '\u00a0': ' ',   # Non-breaking space
+    '\u00ad': None,  # Soft hyphen
+    'ﬀ': 'ff', 'ﬁ': 'fi', 'ﬂ': 'fl', 'ﬃ': 'ffi', 'ﬄ': 'ffl', 'ﬅ': 'st', 'ﬆ': 'st',
+})
+# The word boundary is checked behind the digits rather than before them, so the scan over a whole transcript
+# only stops where a digit pair starts
+TIMESTAMP_PATTERN = re.compile(r'\d{2}:\d{2}:\d{2}(?<!\w\d{2}:\d{2}:\d{2})(?=[^\S\n]*$)', re.MULTILINE)
+LEADING_SYMBOL_PATTERN = re.compile(r'^[^\S\n]*(?:[^\w\s])?', re.MULTILINE)
+# Leading "12" / "12:3" line numbers, matched over the whole normalized buffer; the lookahead skips lines
+# that hold nothing else, which lose their trailing whitespace (and so the match) when stripped
+LINE_NUMBER_PREFIX_PATTERN = re.compile(r'^(\d+)(?::[^\S\n]*(\d+))?[^\S\n]+(?=\S)', re.MULTILINE)
+
+
+def compile_phrase_trie(phrases):
+    """
+    COMPILE A LIST OF LITERAL PHRASES INTO A TRIE-SHAPED REGEX (E.G. MR, MRS, MS -> M(?:R(?:S)?|S))
 
-    # We will be going through line by line to perform various steps. The key to understanding this
-    # code is to understand when and why lines get combined and added. And everything that happens in this
-    # section happens per line.
+    Matching walks one branch per character, so the cost of a match does not grow with the number of phrases.
+    """
+
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}  # End of a phrase
+
+    def to_pattern(node):
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" in node:
+            # A shorter phrase already ends here, so the rest is optional
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return to_pattern(trie) if phrases else "(?!)"
+
+
+def compile_line_classifier(prefixes_by_type):
+    """ COMPILE {LINE TYPE: [PREFIXES]} INTO ONE ANCHORED MATCHER, LINE TYPES ARE TRIED IN ORDER """
+
+    return re.compile("|".join(f"(?P<{line_type}>{compile_phrase_trie(prefixes)})"
+                               for line_type, prefixes in prefixes_by_type.items()))
+
+
+class RuleProfile:
+    """
+    Speaker rules for one court reporter format, compiled once.
+
+    rules may set qa_phrases, objection_phrases, non_party_phrases, swap_phrases and highlight_colors
+    ({"#RRGGBB": name}, for process_pdf_vector_highlights); anything left out falls back to the built-in
+    rules above and VECTOR_HIGHLIGHT_PALETTE. qa_phrases must start with Q or A, the speaker they mark.
+    """
+
+    def __init__(self, name, rules):
+        self.name = name
+        self.qa_phrases = list(rules.get("qa_phrases", QA_PHRASES))
+        self.objection_phrases = list(rules.get("objection_phrases", OBJECTION_PHRASES))
+        self.non_party_phrases = list(rules.get("non_party_phrases", NON_PARTY_PHRASES))
+        self.swap_phrases = dict(rules.get("swap_phrases", SWAP_PHRASE_DICT))
+        for phrase in self.qa_phrases:
+            if not phrase.startswith(("Q", "A")):
+                raise ValueError(f"Rule profile {name}: qa_phrases must start with Q or A, got {phrase!r}")
+
+        # Cache keys include the fingerprint, so editing a profile never serves text parsed with the old rules
+        self.fingerprint = hashlib.sha256(json.dumps(
+            [self.qa_phrases, self.objection_phrases, self.non_party_phrases, self.swap_phrases],
+            sort_keys=True).encode()).hexdigest()[:16]
+
+        self.classifier = compile_line_classifier({
+            "Q": [phrase for phrase in self.qa_phrases if phrase.startswith("Q")],
+            "A": [phrase for phrase in self.qa_phrases if phrase.startswith("A")],
+            "objection": self.objection_phrases,
+            "colloquy": self.non_party_phrases,
+        })
+        self.swap_pattern = re.compile(compile_phrase_trie(list(self.swap_phrases))) if self.swap_phrases else None
+
+        # Kept out of the fingerprint, a palette change doesn't affect parsed transcripts
+        self.palette = (ColorPalette.from_hex(rules["highlight_colors"]) if "highlight_colors" in rules
+                        else default_color_palette)
+
+    def swap(self, line):
+        """ REPLACE EVERY SWAP PHRASE IN THE LINE IN ONE PASS """
+
+        if self.swap_pattern is None:
+            return line
+        return self.swap_pattern.sub(lambda match: self.swap_phrases[match.group(0)], line)
 
-    # for-loop to go through each current line - which at this stage includes any original line breaks.
 
-    # Process each line
-    for i, line in enumerate(text.split('\n')):
-        line = clean_line(line)
+# Per-firm rule profiles, e.g. {"default": {...}, "veritext": {"qa_phrases": ["Q.", "A.", "Q, ", "A, "]}}
+RULE_PROFILES_PATH = os.getenv("RULE_PROFILES_PATH", os.path.join("config", "rule_profiles.json"))
+RULE_PROFILES_CHECK_INTERVAL = float(os.getenv("RULE_PROFILES_CHECK_INTERVAL", "2"))
 
+
+class RuleProfileRegistry:
+    """
+    Rule profiles loaded from a JSON file of {profile name: rules}.
+
+    The file is optional; without it only the built-in "default" profile exists. Its modification time
+    is checked at most every check_interval seconds and the profiles are recompiled when it changes, so
+    new vocabularies take effect without restarting the uplink (each worker process reloads on its own).
+    A file that can't be loaded (invalid or half-written JSON, bad rules) is logged and the last good
+    profiles stay in use until the file changes again.
+    """
+
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._profiles = {"default": RuleProfile("default", {})}
+        self._loaded_mtime = None
+        self._checked_at = 0.0
+        self._reload_or_keep()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        mtime = self._file_mtime()
+        rules_by_name = {}
+        if mtime is not None:
+            with open(self.path, 'r') as f:
+                rules_by_name = json.load(f)
+
+        profiles = {name: RuleProfile(name, rules) for name, rules in rules_by_name.items()}
+        profiles.setdefault("default", RuleProfile("default", {}))
+        with self._lock:
+            self._profiles = profiles
+            self._loaded_mtime = mtime
+            self._checked_at = time.time()
+        return sorted(profiles)
+
+    def _reload_or_keep(self):
+        mtime = self._file_mtime()
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"Could not load rule profiles from {self.path}, keeping the current ones: {e}")
+            with self._lock:
+                # Not retried until the file changes again
+                self._loaded_mtime = mtime
+
+    def get(self, name=None):
+        if time.time() - self._checked_at > self.check_interval:
+            self._checked_at = time.time()
+            if self._file_mtime() != self._loaded_mtime:
+                self._reload_or_keep()
+        with self._lock:
+            if (name or "default") not in self._profiles:
+                raise ValueError(f"Unknown rule profile: {name}")
+            return self._profiles[name or "default"]
+
+
+rule_profiles = RuleProfileRegistry(RULE_PROFILES_PATH, RULE_PROFILES_CHECK_INTERVAL)
+
+
+@anvil.server.callable()
+def reload_rule_profiles():
+    # Reloads the rule profile file in the uplink process now, the workers pick it up on their next check
+    return rule_profiles.reload()
+
+
+@anvil.server.callable()
+def prepare_text_for_powerpoint(text, name_checkbox_state, obj_checkbox_state,
+                                detect_pages_checkbox_state, witness_name_checkbox_state, witness_name_text,
+                                profile=None):
+    # The cleaning itself runs on the worker pool so long transcripts don't stall other callers
+    return run_with_transcript_model(text, profile, render_powerpoint, name_checkbox_state, obj_checkbox_state,
+                                     detect_pages_checkbox_state, witness_name_checkbox_state, witness_name_text)
+
+
+@anvil.server.callable()
+def prepare_text_for_powerpoint_batch(excerpts, options):
+    """
+    Cleans a list of excerpts in one call and returns the results in the same order.
+
+    options is either one dict shared by every excerpt or a list with one dict per excerpt, using the keys
+    hide_names, hide_objections, detect_pages, show_witness_name, witness_name and profile.
+    """
+    if isinstance(options, dict):
+        options = [options] * len(excerpts)
+    if len(options) != len(excerpts):
+        raise ValueError("options must be a single dict or one dict per excerpt.")
+
+    # Excerpts already in the transcript cache are sent to the workers parsed, the rest as text
+    cache_keys = [transcript_handle(text, item_options.get("profile"))
+                  for text, item_options in zip(excerpts, options)]
+    jobs = [(cached_transcript(cache_key, text), powerpoint_option_args(item_options), item_options.get("profile"))
+            for cache_key, text, item_options in zip(cache_keys, excerpts, options)]
+
+    # Large batches are split across the workers, the chunks come back in order
+    shard_count = max(min(worker_pool.max_workers, len(jobs)), 1)
+    futures = [worker_pool.submit(render_powerpoint_jobs, chunk)
+               for chunk in split_into_shards(jobs, shard_count)]
+    results = [result for future in futures for result in future.result()]
+    for cache_key, (parsed_model, processed_text) in zip(cache_keys, results):
+        if parsed_model is not None:
+            cache_parsed_transcript(cache_key, parsed_model)
+    return [processed_text for parsed_model, processed_text in results]
+
+
+def powerpoint_option_args(options):
+    """Maps a batch options dict onto the checkbox arguments of render_powerpoint."""
+    return (bool(options.get("hide_names", False)), bool(options.get("hide_objections", False)),
+            bool(options.get("detect_pages", False)), bool(options.get("show_witness_name", False)),
+            options.get("witness_name", ""))
+
+
+def render_powerpoint_jobs(jobs):
+    """Runs render_powerpoint over a list of (model or text, checkbox arguments, profile) items."""
+    return [render_transcript(transcript, profile, render_powerpoint, *args) for transcript, args, profile in jobs]
+
+
+def render_powerpoint(model, name_checkbox_state, obj_checkbox_state,
+                      detect_pages_checkbox_state, witness_name_checkbox_state, witness_name_text, rows=None):
+    """
+    Renders a parsed transcript (or only the given rows of it) for PowerPoint output.
+    """
+    # Finished speaker turns are joined as they come out of the cleaner
+    line_numbers = {'first': None, 'last': None}
+    processed_text = ''.join(iter_powerpoint_groups(model, name_checkbox_state, obj_checkbox_state,
+                                                    detect_pages_checkbox_state, line_numbers, rows)).strip()
+
+    # Append witness name and page/line range if applicable
+    first_num, last_num = line_numbers['first'], line_numbers['last']
+    if witness_name_checkbox_state and first_num is not None and last_num is not None:
+        processed_text += f'\n\n{witness_name_text} Tr. Pg. __, Ln. {first_num}-{last_num}'
+
+    return processed_text
+
+
+def normalize_transcript_text(text, profile=None):
+    """
+    Cleans every line of the text in a few whole-buffer passes and returns the result with the same line count.
+
+    Special characters are mapped through TEXT_TRANSLATION_TABLE, the profile's swap phrases are replaced,
+    trailing timestamps and leading whitespace are removed and a single leading symbol is dropped
+    (no speaker prefix starts with one). Trailing whitespace is left for the caller to strip per line.
+    """
+    text = text.translate(TEXT_TRANSLATION_TABLE)
+    text = (profile or rule_profiles.get()).swap(text)
+    text = TIMESTAMP_PATTERN.sub('', text)
+    return LEADING_SYMBOL_PATTERN.sub('', text)
+
+
+def iter_powerpoint_groups(model, name_checkbox_state, obj_checkbox_state, detect_pages_checkbox_state,
+                           line_numbers, rows=None):
+    """
+    Assembles the parsed lines into speaker turns and yields each turn as soon as it is finished.
+
+    A turn is kept as a list of parts and joined once, so building it is linear in its length.
+    Objection and colloquy turns are capitalized, or dropped when obj_checkbox_state is set. When
+    detect_pages_checkbox_state is set, the first and last line numbers seen are stored in line_numbers.
+    rows limits the output to those row indexes, in the order given.
+    """
+    # We will be going through line by line to perform various steps. The key to understanding this
+    # code is to understand when and why lines get combined and added.
+    mode = 1 if detect_pages_checkbox_state else 0
+    content_start, line_types, name_lines = model.content_start[mode], model.line_type[mode], model.is_name_line[mode]
+    label_lengths = model.label_length[mode]
+    turn = []
+    capitalize = False
+
+    def finish_turn():
+        phrase = " ".join(turn)
+        if not capitalize:
+            return phrase
+        return None if obj_checkbox_state else phrase.upper()
+
+    for row in range(len(model)) if rows is None else rows:
         # Handle page number detection
-        if detect_pages_checkbox_state:
-            match = re.match(r'^(\d+)\s+', line)
-            if match:
-                num = int(match.group(1))
-                if first_num is None:
-                    first_num = num
-                last_num = num
-                line = line[match.end():].strip()
-        else:
-            match = re.match(r'^\d+(:\s*\d+)?\s+', line)
-            if match:
-                line = line[match.end():].strip()
+        if detect_pages_checkbox_state and content_start[row] != model.text_start[row]:
+            if line_numbers['first'] is None:
+                line_numbers['first'] = model.line_no[row]
+            line_numbers['last'] = model.line_no[row]
 
         # Skip lines based on checkbox states
-        if name_checkbox_state and line.startswith(("QUESTIONS BY", "BY")) and ":" in line:
+        if name_checkbox_state and name_lines[row]:
             continue
 
         # Process lines starting with specific phrases
-        if any(line.startswith(phrase) for phrase in qa_phrases):
-            if phrase_being_assembled:
-                completed_line_groups.append(process_line_groups(phrase_being_assembled, capitalize))
-            phrase_being_assembled = f"\n{line[:2]}\t{line[2:].strip()}"
-            capitalize = False
-
-        elif any(line.startswith(phrase) for phrase in objection_phrases + non_party_phrases):
-            if phrase_being_assembled:
-                completed_line_groups.append(process_line_groups(phrase_being_assembled, capitalize))
-            phrase_being_assembled = f"\n{line}"
-            capitalize = True
+        line = model.buffer[content_start[row]:model.text_end[row]]
+        line_type = TRANSCRIPT_LINE_TYPES[line_types[row]]
+        if line_type in ("Q", "A", "objection", "colloquy"):
+            if turn:
+                phrase = finish_turn()
+                if phrase is not None:
+                    yield phrase
+            if line_type in ("Q", "A"):
+                # The matched phrase is the label ("Q." or "QUESTION:"), at least two characters like "Q "
+                label_length = max(label_lengths[row], 2)
+                turn = [f"\n{line[:label_length]}\t{line[label_length:].strip()}"]
+                capitalize = False
+            else:
+                turn = [f"\n{line}"]
+                capitalize = True
+
+        elif line and not capitalize:
+            turn.append(line)
+
+    # Add the final assembled turn
+    if turn:
+        phrase = finish_turn()
+        if phrase is not None:
+            yield phrase
+
+
+# Parsed transcript model shared by the PowerPoint, OnCue and PDF excerpt output modes
+TRANSCRIPT_CACHE_ITEMS = int(os.getenv("TRANSCRIPT_CACHE_ITEMS", "32"))
+TRANSCRIPT_LINE_TYPES = ("other", "Q", "A", "objection", "colloquy")
+ONCUE_LINES_PER_PAGE = int(os.getenv("ONCUE_LINES_PER_PAGE", "25"))  # A range ending on this line continues on the next page
+
+# Captured numbers are at most 9 digits, so they always fit the model's integer arrays; longer ones are
+# treated as text rather than page or line numbers
+RAW_LINE_NUMBER_PATTERN = re.compile(r'^(\d{1,9})[^\S\n]*$', re.MULTILINE)
+PAGE_HEADER_PATTERN = re.compile(r'^[^\S\n]*Pg\. (\d{1,9})(?!\d)', re.MULTILINE)
+# OnCue tokens in pasted text: "12:3-9:" on one page, or "12:20-13:4" across pages
+DESIGNATION_TOKEN_PATTERN = re.compile(r'(?<!\S)(\d{1,9}):(\d{1,9})-(?:(\d{1,9}):(\d{1,9})(?=:|\s|$)|(\d{1,9}):)\S*')
+DESIGNATION_PATTERN = re.compile(r'(\d{1,9}):(\d{1,9})\s*-\s*(?:(\d{1,9}):)?(\d{1,9}):?')  # "12:3-7" or "12:3-14:7"
+
+
+class TranscriptModel:
+    """
+    Compact, array-backed parse of a transcript, built once and rendered by every output mode.
+
+    Every line is a row. Row columns are arrays of offsets into two shared buffers: source (the text as
+    pasted) and buffer (the cleaned lines), plus the page, line number and speaker type of the row. The
+    content start, speaker type, Q/A label length and "BY ..." name line flag are kept for both line number
+    modes, indexed
+    by 0 (strip "12" / "12:3" prefixes) and 1 (detect pages: strip and record the line number), so
+    changing an output option never needs a reparse. fingerprint is that of the rule profile it was parsed with.
+    """
+
+    def __init__(self, source, fingerprint=""):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.buffer = ""
+        self.raw_start, self.raw_end = array('l'), array('l')
+        self.text_start, self.text_end = array('l'), array('l')
+        self.page, self.line_no, self.raw_line_no = array('l'), array('l'), array('l')
+        self.content_start = (array('l'), array('l'))
+        self.line_type = (array('b'), array('b'))
+        self.label_length = (array('l'), array('l'))  # Length of the matched Q/A phrase, trailing spaces excluded
+        self.is_name_line = (array('b'), array('b'))
+
+    def __len__(self):
+        return len(self.text_start)
+
+
+def line_offsets(lines):
+    """ START AND END OFFSETS OF EACH LINE ONCE THE LINES ARE JOINED WITH NEWLINES, AS TWO ARRAYS """
+
+    lengths = array('l', map(len, lines))
+    starts = array('l', accumulate(map(add, lengths, repeat(1)), initial=0))
+    starts.pop()
+    return starts, array('l', map(add, starts, lengths))
+
+
+def parse_transcript(text, profile_name=None):
+    """
+    PARSE TRANSCRIPT TEXT INTO A TranscriptModel
+
+    Every column is filled by a pass over the whole buffer (or a comprehension over its rows); only the
+    rows holding a page header or line number prefix are visited one at a time.
+    """
+
+    profile = rule_profiles.get(profile_name)
+    model = TranscriptModel(text, profile.fingerprint)
+    normalized = normalize_transcript_text(text, profile)
+
+    # Normalization keeps line breaks where they are, so the raw, normalized and cleaned lines share row numbers
+    raw_lines = text.split("\n")
+    normalized_lines = normalized.split("\n")
+    lines = [line.rstrip() for line in normalized_lines]
+    for row in [row for row, line in enumerate(lines) if line.startswith("Pg. ")]:
+        lines[row] = "\n\n" + lines[row]
+    model.buffer = buffer = "\n".join(lines)
+    model.raw_start, model.raw_end = line_offsets(raw_lines)
+    model.text_start, model.text_end = line_offsets(lines)
+    row_count = len(lines)
+
+    model.raw_line_no = array('l', [-1]) * row_count
+    raw_rows = dict(zip(model.raw_start, range(row_count)))
+    for match in RAW_LINE_NUMBER_PATTERN.finditer(text):
+        model.raw_line_no[raw_rows[match.start()]] = int(match.group(1))
+
+    # Page and line number, from "Pg. 12:..." headers, "12:3" prefixes or plain "3" prefixes. Mode 0 strips
+    # either prefix; mode 1 only strips a plain one, and otherwise keeps the whole line as content
+    normalized_rows = dict(zip(line_offsets(normalized_lines)[0], range(row_count)))
+    page_changes = {normalized_rows[match.start()]: int(match.group(1))
+                    for match in PAGE_HEADER_PATTERN.finditer(normalized)}
+    model.line_no = line_no = array('l', [-1]) * row_count
+    content_start = array('l', model.text_start)
+    unstripped_rows = []
+    for match in LINE_NUMBER_PREFIX_PATTERN.finditer(normalized):
+        start, end = match.span()
+        row = normalized_rows[start]
+        number, line_of_page = match.groups()
+        content_start[row] += end - start
+        if line_of_page is None and len(number) <= 9:
+            line_no[row] = int(number)
+            continue
+        unstripped_rows.append(row)
+        if line_of_page is not None and len(number) <= 9 and len(line_of_page) <= 9:
+            page_changes[row] = int(number)
+            model.line_no[row] = int(line_of_page)
+
+    model.page = array('l', [-1]) * row_count
+    changes = sorted(page_changes.items())
+    for (row, page), (next_row, _) in zip(changes, changes[1:] + [(row_count, None)]):
+        model.page[row:next_row] = array('l', [page]) * (next_row - row)
+
+    # Speaker type and "BY ..." name line flag of each row's content, for both modes
+    line_types = {line_type: code for code, line_type in enumerate(TRANSCRIPT_LINE_TYPES)}
+    classify = profile.classifier.match
+    matches = list(map(classify, repeat(buffer), content_start, model.text_end))
+    model.line_type[0].extend(line_types[match.lastgroup] if match else 0 for match in matches)
+    model.label_length[0].extend(len(match.group().rstrip()) if match and match.lastgroup in ("Q", "A") else 0
+                                 for match in matches)
+    model.is_name_line[0].extend(
+        buffer.startswith(("QUESTIONS BY", "BY"), start, end) and buffer.find(":", start, end) >= 0
+        for start, end in zip(content_start, model.text_end))
+    model.content_start = (content_start, array('l', content_start))
+    model.line_type[1].extend(model.line_type[0])
+    model.label_length[1].extend(model.label_length[0])
+    model.is_name_line[1].extend(model.is_name_line[0])
+    for row in unstripped_rows:
+        start, end = model.text_start[row], model.text_end[row]
+        match = classify(buffer, start, end)
+        model.content_start[1][row] = start
+        model.line_type[1][row] = line_types[match.lastgroup] if match else 0
+        model.label_length[1][row] = len(match.group().rstrip()) if match and match.lastgroup in ("Q", "A") else 0
+        model.is_name_line[1][row] = buffer.startswith(("QUESTIONS BY", "BY"), start, end) and buffer.find(":", start, end) >= 0
+
+    return model
+
+
+transcript_cache = ResultCache(TRANSCRIPT_CACHE_ITEMS, "", 0)
+
+
+def transcript_handle(transcript, profile_name=None, fingerprint=None):
+    """ CONTENT HASH OF A TRANSCRIPT (TEXT OR PDF BYTES) PLUS THE RULE PROFILE IT IS PARSED WITH """
+
+    profile = rule_profiles.get(profile_name)
+    data = transcript.encode("utf-8", "surrogatepass") if isinstance(transcript, str) else transcript
+    return content_cache_key(data, "transcript", profile.name, fingerprint or profile.fingerprint)
+
+
+def cache_parsed_transcript(cache_key, model):
+    """
+    CACHE A MODEL A WORKER PARSED, IF IT WAS PARSED WITH THE RULES cache_key WAS BUILT FOR
+
+    Each worker reloads rule profiles on its own schedule, so right after a profile edit a worker can parse
+    with other rules than this process used for the key. That model is still used for the one call, but
+    caching it would serve the wrong rules under the key. Returns whether the model was cached.
+    """
+
+    if not cache_key.endswith(f"-{model.fingerprint}"):
+        return False
+    transcript_cache.put(cache_key, model)
+    return True
+
+
+def cached_transcript(cache_key, transcript):
+    """ THE CACHED MODEL FOR cache_key, OR THE TRANSCRIPT ITSELF WHEN IT STILL HAS TO BE PARSED """
+
+    model = transcript_cache.get(cache_key)
+    return transcript if model is None else model
+
+
+def render_transcript(transcript, profile_name, render, *args):
+    """
+    RUN render(model, *args) ON A PARSED TRANSCRIPT, PARSING TEXT OR PDF BYTES FIRST
+
+    Returns (the newly parsed model or None, the result), so the caller can cache the model.
+    """
+
+    if isinstance(transcript, TranscriptModel):
+        return None, render(transcript, *args)
+    text = transcript if isinstance(transcript, str) else transcript_pdf_text(transcript)
+    model = parse_transcript(text, profile_name)
+    return model, render(model, *args)
+
+
+def run_with_transcript_model(transcript, profile_name, render, *args):
+    """
+    RUN render(model, *args) ON THE WORKER POOL, PARSING THE TRANSCRIPT ONLY THE FIRST TIME IT IS SEEN
+
+    The transcript cache lives in this (uplink) process, each worker process would otherwise keep its
+    own copy and parse the same text again. A cached model is sent to the worker for rendering only; a new
+    transcript is parsed and rendered in one job and the worker sends its model back to be cached.
+    """
+
+    cache_key = transcript_handle(transcript, profile_name)
+    parsed_model, result = worker_pool.run(render_transcript, cached_transcript(cache_key, transcript),
+                                           profile_name, render, *args)
+    if parsed_model is not None:
+        cache_parsed_transcript(cache_key, parsed_model)
+    return result
+
+
+TEXT_SESSION_TTL = int(os.getenv("TEXT_SESSION_TTL", "3600"))  # Seconds an unused text handle is kept
+TEXT_SESSION_MAX_ITEMS = int(os.getenv("TEXT_SESSION_MAX_ITEMS", "256"))
+
+
+class TextSessionStore:
+    """
+    Parsed transcripts held server-side for load_text / render_text, keyed by handle.
+
+    Handles expire ttl seconds after they were last used, and the least recently used handle is
+    dropped once more than max_items are loaded.
+    """
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        while self._sessions and next(iter(self._sessions.values()))[1] < cutoff:
+            self._sessions.popitem(last=False)
+
+    def put(self, handle, model):
+        with self._lock:
+            self._sessions[handle] = (model, time.time())
+            self._sessions.move_to_end(handle)
+            self._expire()
+            while len(self._sessions) > self.max_items:
+                self._sessions.popitem(last=False)
+
+    def get(self, handle):
+        with self._lock:
+            self._expire()
+            if handle not in self._sessions:
+                raise KeyError(f"Unknown or expired text handle: {handle}")
+            model = self._sessions[handle][0]
+            self._sessions[handle] = (model, time.time())
+            self._sessions.move_to_end(handle)
+            return model
+
+
+text_sessions = TextSessionStore(TEXT_SESSION_MAX_ITEMS, TEXT_SESSION_TTL)
+
+
+@anvil.server.callable()
+def load_text(text, profile=None):
+    # Parses the transcript once and keeps it server-side, checkbox toggles then only send the handle
+    handle = transcript_handle(text, profile)
+    try:
+        text_sessions.get(handle)
+    except KeyError:
+        model = transcript_cache.get(handle)
+        if model is None:
+            model = worker_pool.run(parse_transcript, text, profile)
+            if not cache_parsed_transcript(handle, model):
+                # Parsed with other rules than the handle names, so it gets the handle of the rules it used
+                handle = transcript_handle(text, profile, model.fingerprint)
+        text_sessions.put(handle, model)
+    return handle
+
+
+@anvil.server.callable()
+def render_text(handle, options):
+    # Re-renders a loaded transcript with new checkbox options (same keys as prepare_text_for_powerpoint_batch)
+    return render_powerpoint(text_sessions.get(handle), *powerpoint_option_args(options))
+
+
+def parse_designation(designation):
+    """ PARSE "12:3-7" OR "12:3-14:7" INTO (START PAGE, START LINE, END PAGE, END LINE) """
+
+    match = DESIGNATION_PATTERN.fullmatch(designation.strip())
+    if not match:
+        raise ValueError(f"Not a page:line designation: {designation!r}")
+    start_page, start_line, end_page, end_line = match.groups()
+    return int(start_page), int(start_line), int(end_page or start_page), int(end_line)
+
+
+def next_designation_line(page, line_no, lines_per_page=None):
+    """ THE (PAGE, LINE) AFTER page:line, WRAPPING TO LINE 1 OF THE NEXT PAGE AFTER THE LAST LINE """
+
+    if line_no >= (lines_per_page or ONCUE_LINES_PER_PAGE):
+        return page + 1, 1
+    return page, line_no + 1
+
+
+def coalesce_designations(designations, lines_per_page=None):
+    """
+    Sorts (start page, start line, end page, end line) designations and merges the ones that overlap or
+    touch, including a range that picks up on line 1 right after another ends on the last line of a page.
+
+    Reversed ranges ("12:9-3") are read from their lower end. Sorting is O(n log n) and the merge is
+    one pass, so the result is a sorted list of disjoint intervals.
+    """
 
+    intervals = sorted(designation if designation[2:] >= designation[:2] else (*designation[2:], *designation[:2])
+                       for designation in map(tuple, designations))
+    merged = []
+    for start_page, start_line, end_page, end_line in intervals:
+        if merged and (start_page, start_line) <= next_designation_line(*merged[-1][2:], lines_per_page):
+            if (end_page, end_line) > merged[-1][2:]:
+                merged[-1] = (*merged[-1][:2], end_page, end_line)
         else:
-            if line and not capitalize:
-                if phrase_being_assembled:
-                    phrase_being_assembled += " "
-                phrase_being_assembled += line
+            merged.append((start_page, start_line, end_page, end_line))
+    return merged
 
-    # Add the final assembled phrase
-    if phrase_being_assembled:
-        completed_line_groups.append(process_line_groups(phrase_being_assembled, capitalize))
 
-    # Remove objection lines if checkbox is checked
-    if obj_checkbox_state:
-        completed_line_groups = [line for line in completed_line_groups if not line.isupper()]
+def format_designation(designation):
+    """ FORMAT (START PAGE, START LINE, END PAGE, END LINE) AS "12:3-9" OR "12:20-13:4" """
 
-    # Combine processed lines
-    processed_text = ''.join(completed_line_groups).strip()
+    start_page, start_line, end_page, end_line = designation
+    if start_page == end_page:
+        return f"{start_page}:{start_line}-{end_line}"
+    return f"{start_page}:{start_line}-{end_page}:{end_line}"
 
-    # Append witness name and page/line range if applicable
-    if witness_name_checkbox_state and first_num is not None and last_num is not None:
-        processed_text += f'\n\n{witness_name_text} Tr. Pg. __, Ln. {first_num}-{last_num}'
 
-    return processed_text
+def previous_designation_line(page, line_no, lines_per_page=None):
+    """ THE (PAGE, LINE) BEFORE page:line, WRAPPING TO THE LAST LINE OF THE PREVIOUS PAGE BEFORE LINE 1 """
+
+    if line_no <= 1:
+        return page - 1, lines_per_page or ONCUE_LINES_PER_PAGE
+    return page, line_no - 1
+
+
+def intersect_designations(designations, others):
+    """ LINES IN BOTH OF TWO SORTED, DISJOINT DESIGNATION LISTS, AS ONE SORTED LIST, IN ONE MERGE PASS """
+
+    result = []
+    i = j = 0
+    while i < len(designations) and j < len(others):
+        start = max(designations[i][:2], others[j][:2])
+        end = min(designations[i][2:], others[j][2:])
+        if start <= end:
+            result.append((*start, *end))
+        if designations[i][2:] < others[j][2:]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def subtract_designations(designations, others, lines_per_page=None):
+    """
+    LINES OF ONE SORTED, DISJOINT DESIGNATION LIST THAT ARE NOT IN ANOTHER, IN ONE MERGE PASS
+
+    A range cut just before line 1 ends on the last line of the previous page, and one cut after the
+    last line of a page picks up on line 1 of the next, the same wrap coalesce_designations uses.
+    """
+
+    result = []
+    j = 0
+    for start_page, start_line, end_page, end_line in designations:
+        start, end = (start_page, start_line), (end_page, end_line)
+        while j < len(others) and others[j][2:] < start:
+            j += 1
+        # others[j:] may reach into the next designation too, so j only moves past ranges that end before it
+        k = j
+        while k < len(others) and others[k][:2] <= end and start <= end:
+            before = previous_designation_line(*others[k][:2], lines_per_page)
+            if start <= before:
+                result.append((*start, *before))
+            start = max(start, next_designation_line(*others[k][2:], lines_per_page))
+            k += 1
+        if start <= end:
+            result.append((*start, *end))
+    return result
+
+
+def iter_line_extents(model):
+    """
+    Yields (page, line, first row, last row) for every numbered line of a parsed transcript, in order.
+
+    A line runs until the next numbered line or page header, so wrapped text stays with the line above
+    it (trailing blank rows do not). A bare line number is a numbered line too, a blank line of the
+    transcript. Rows before the first page number is known are skipped.
+    """
+
+    extent = None
+    for row in range(len(model)):
+        page, line_no = model.page[row], model.line_no[row]
+        if line_no < 0:
+            line_no = model.raw_line_no[row]
+        if extent is not None and (line_no >= 0 or page != extent[0]):
+            yield tuple(extent)
+            extent = None
+        if line_no >= 0 and page >= 0:
+            extent = [page, line_no, row, row]
+        elif extent is not None and model.text_end[row] > model.text_start[row]:
+            extent[3] = row
+    if extent is not None:
+        yield tuple(extent)
+
+
+# Page:line indexes over loaded transcripts for get_excerpt
+TRANSCRIPT_INDEX_DIR = os.getenv("TRANSCRIPT_INDEX_DIR",
+                                 os.path.join(RESULT_CACHE_DIR or tempfile.gettempdir(), "transcripts"))
+TRANSCRIPT_INDEX_MEMORY_ITEMS = int(os.getenv("TRANSCRIPT_INDEX_MEMORY_ITEMS", "32"))
+TRANSCRIPT_INDEX_MAX_BYTES = int(os.getenv("TRANSCRIPT_INDEX_MAX_MB", "256")) * 1024 * 1024
+
+
+class TranscriptIndex:
+    """
+    Byte offsets of every page:line of a transcript, over a memory-mapped copy of the text as pasted.
+
+    The text is stored as text_path (UTF-8) and the offsets as index_path, an array of
+    (page, line, start, end) quadruples, so an index outlives the text handle it was built from and a
+    lookup is one dict access plus one slice of the mapped file.
+    """
+
+    def __init__(self, text_path, index_path):
+        entries = array('q')
+        with open(index_path, 'rb') as f:
+            entries.frombytes(f.read())
+        self._offsets = {(entries[i], entries[i + 1]): (entries[i + 2], entries[i + 3])
+                         for i in range(0, len(entries), 4)}
+        with open(text_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    @staticmethod
+    def write(model, text_path, index_path):
+        """ STORE THE TEXT AND LINE OFFSETS OF A PARSED TRANSCRIPT FOR TranscriptIndex """
+
+        # Byte offsets of every row, the model's offsets count characters
+        data = model.source.encode("utf-8", "surrogatepass")
+        row_start, row_end = array('q'), array('q')
+        offset = 0
+        for row in range(len(model)):
+            row_start.append(offset)
+            offset += len(model.source[model.raw_start[row]:model.raw_end[row]].encode("utf-8", "surrogatepass"))
+            row_end.append(offset)
+            offset += 1  # The newline
+
+        # The first occurrence of a page:line wins if a transcript repeats one
+        entries = array('q')
+        seen_lines = set()
+        for page, line_no, first_row, last_row in iter_line_extents(model):
+            if (page, line_no) not in seen_lines:
+                seen_lines.add((page, line_no))
+                entries.extend((page, line_no, row_start[first_row], row_end[last_row]))
+
+        # Scratch files first, like the result cache, so a reader never maps a half written index
+        for path, content in ((text_path, data), (index_path, entries.tobytes())):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+    def excerpt(self, start_page, start_line, end_page, end_line):
+        """ THE TEXT FROM THE START OF start_page:start_line TO THE END OF end_page:end_line """
+
+        for page, line_no in ((start_page, start_line), (end_page, end_line)):
+            if (page, line_no) not in self._offsets:
+                raise ValueError(f"Line {page}:{line_no} is not in this transcript")
+        start = self._offsets[(start_page, start_line)][0]
+        end = self._offsets[(end_page, end_line)][1]
+        if end < start:
+            raise ValueError(f"Designation {start_page}:{start_line}-{end_page}:{end_line} ends before it starts")
+        return self._map[start:end].decode("utf-8", "surrogatepass")
+
+
+transcript_indexes = ResultCache(TRANSCRIPT_INDEX_MEMORY_ITEMS, "", 0)
+
+
+def evict_transcript_indexes(keep_name):
+    """
+    REMOVE THE LEAST RECENTLY USED INDEXES ONCE TRANSCRIPT_INDEX_DIR GROWS PAST TRANSCRIPT_INDEX_MAX_BYTES
+
+    The text and index file of a transcript are removed together. keep_name, the index just written,
+    is never removed. An index that is still mapped stays readable, it is only rebuilt on its next load.
+    """
+
+    sizes, mtimes = {}, {}
+    for entry in os.scandir(TRANSCRIPT_INDEX_DIR):
+        name, extension = os.path.splitext(entry.name)
+        if extension in (".txt", ".idx"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            sizes[name] = sizes.get(name, 0) + stat.st_size
+            mtimes[name] = max(mtimes.get(name, 0.0), stat.st_mtime)
+
+    total = sum(sizes.values())
+    for name in sorted(mtimes, key=mtimes.get):
+        if total <= TRANSCRIPT_INDEX_MAX_BYTES:
+            break
+        if name == keep_name:
+            continue
+        # The index goes first, so a reader never finds an index without its text
+        for extension in (".idx", ".txt"):
+            try:
+                os.remove(os.path.join(TRANSCRIPT_INDEX_DIR, name + extension))
+            except OSError:
+                pass
+        total -= sizes[name]
+
+
+def get_transcript_index(handle):
+    """ RETURN THE INDEX FOR A load_text HANDLE, WRITING IT FROM THE LOADED TRANSCRIPT THE FIRST TIME """
+
+    index = transcript_indexes.get(handle)
+    if index is None:
+        # Handles come from the client, so the file name is a hash of the handle rather than the handle
+        name = hashlib.sha256(handle.encode("utf-8", "surrogatepass")).hexdigest()
+        text_path = os.path.join(TRANSCRIPT_INDEX_DIR, f"{name}.txt")
+        index_path = os.path.join(TRANSCRIPT_INDEX_DIR, f"{name}.idx")
+        if os.path.exists(index_path):
+            os.utime(index_path)  # Mark as recently used for eviction
+        else:
+            model = text_sessions.get(handle)
+            os.makedirs(TRANSCRIPT_INDEX_DIR, exist_ok=True)
+            TranscriptIndex.write(model, text_path, index_path)
+            evict_transcript_indexes(name)
+        index = TranscriptIndex(text_path, index_path)
+        transcript_indexes.put(handle, index)
+    return index
+
+
+@anvil.server.callable()
+def get_excerpt(transcript_id, designation):
+    # Slices "12:3-14:7" out of a transcript loaded with load_text, without cleaning it again
+    return get_transcript_index(transcript_id).excerpt(*parse_designation(designation))
+
+
+@anvil.server.callable()
+def resolve_designations(transcript, designations, options=None):
+    """
+    Turns a list of designations ("12:3-7", "12:20-13:4") back into cleaned slide text, in one request.
+
+    transcript is the pasted text or a transcript PDF (Media). options uses the same keys as
+    prepare_text_for_powerpoint_batch and applies to every excerpt. Returns one
+    {"designation", "text"} dict per designation, in the order given, with an "error" key instead of
+    text for designations that can't be read or fall outside the transcript.
+    """
+    if not isinstance(transcript, str):
+        transcript = transcript.get_bytes()
+    options = options or {}
+    return run_with_transcript_model(transcript, options.get("profile"), resolve_designation_excerpts,
+                                     list(designations), options)
+
+
+def resolve_designation_excerpts(model, designations, options):
+    """ RESOLVE DESIGNATIONS AGAINST A PARSED TRANSCRIPT IN ONE SORTED SWEEP """
+
+    extents = sorted(iter_line_extents(model))
+    line_keys = [(page, line_no) for page, line_no, first_row, last_row in extents]
+    option_args = powerpoint_option_args(options)
+
+    results = [None] * len(designations)
+    cites = []
+    for i, designation in enumerate(designations):
+        try:
+            cites.append((parse_designation(designation), i))
+        except ValueError as e:
+            results[i] = {"designation": designation, "error": str(e)}
+    cites.sort()
+
+    # Starts are visited in order, so the start position only ever moves forward through the lines
+    start = 0
+    for (start_page, start_line, end_page, end_line), i in cites:
+        while start < len(line_keys) and line_keys[start] < (start_page, start_line):
+            start += 1
+        end = bisect.bisect_right(line_keys, (end_page, end_line), start)
+        if start == end:
+            results[i] = {"designation": designations[i], "error": "No transcript lines in this designation"}
+            continue
+        # Only the numbered lines' rows, so page headers between them don't end up on the slide
+        rows = [row for page, line_no, first_row, last_row in extents[start:end]
+                for row in range(first_row, last_row + 1)]
+        results[i] = {"designation": designations[i], "text": render_powerpoint(model, *option_args, rows=rows)}
+    return results
+
+
+def iter_designation_tokens(text):
+    """ YIELD (START PAGE, START LINE, END PAGE, END LINE) FOR EVERY ONCUE TOKEN ("12:3-9:", "12:20-13:4") IN TEXT """
+
+    for match in DESIGNATION_TOKEN_PATTERN.finditer(text):
+        start_page, start_line, end_page, end_line, same_page_end = match.groups()
+        if end_page is None:
+            end_page, end_line = start_page, same_page_end
+        elif int(end_page) < int(start_page):
+            # "14:1-5:30" is a one page range followed by other text, not a range that runs backwards
+            end_page, end_line = start_page, end_page
+        yield int(start_page), int(start_line), int(end_page), int(end_line)
+
+
+def render_oncue(text):
+    """ RENDER THE DESIGNATION TOKENS IN TEXT AS A SORTED, MERGED ONCUE LIST """
+
+    return "\n".join(map(format_designation, coalesce_designations(iter_designation_tokens(text))))
+
+
+def render_pdf_excerpt(model, page_num):
+    """ RENDER A PARSED PDF HIGHLIGHT AS {"PAGE:FIRST-LAST": TEXT}, JOINING BARE LINE NUMBERS TO THEIR TEXT """
+
+    processed_text = []
+    first_line_number = None
+    last_line_number = None
+
+    for row in range(len(model)):
+        line_number = model.raw_line_no[row]
+        if line_number >= 0:
+            # Track the first and last line numbers
+            if first_line_number is None:
+                first_line_number = line_number
+            last_line_number = line_number
+
+            # Append line number with the subsequent line of text
+            if row + 1 < len(model):
+                next_line = model.source[model.raw_start[row + 1]:model.raw_end[row + 1]]
+                processed_text.append(f"{line_number} {next_line}")
+        elif row == 0 or model.raw_line_no[row - 1] < 0:
+            # Include lines that are not immediately after a line number
+            processed_text.append(model.source[model.raw_start[row]:model.raw_end[row]])
+
+    # Format the line range and page information
+    line_range_info = f"{page_num + 1}:{first_line_number}-{last_line_number}" if (first_line_number and
+                                                                                   last_line_number) else f"{page_num + 1}"
+
+    return {line_range_info: '\n'.join(processed_text)}
 
 
 ## CHATGPT ##
@@ -410,18 +2025,59 @@ def prepare_text_for_powerpoint(text, name_checkbox_state, obj_checkbox_state,
 
 @anvil.server.callable()
 def prepare_text_for_oncue(text):
-    matches = []
-    lines = text.split()
-    for i, line in enumerate(lines):
-        line = line.strip()  # Strips any white-space at the beginning or end of a line
-        match = re.match(r'\d+:\d+-\d+:', line)
+    # Only the designation tokens are needed, so the text is scanned for them rather than fully parsed
+    return render_oncue(text)
 
-        if match:
-            matches.append(line.rstrip(":"))
 
-    sorted_matches = sorted(matches, key=sort_key)
-    processed_text = "\n".join(sorted_matches)
-    return processed_text
+def combine_designation_lists(designation_lists, combine):
+    """
+    Applies combine(designations, designations) across designation lists and returns OnCue lines.
+
+    Each list is a list of designation strings or OnCue text with one designation per line. combine gets
+    two sorted lists of disjoint (start page, start line, end page, end line) ranges, so every step is a
+    merge over the ranges and the cost depends on how many there are, not on how many lines they span.
+    """
+    if len(designation_lists) < 2:
+        raise ValueError("At least two designation lists are needed.")
+
+    parsed_lists = []
+    for designations in designation_lists:
+        if isinstance(designations, str):
+            designations = designations.splitlines()
+        parsed_lists.append(coalesce_designations(parse_designation(designation)
+                                                  for designation in designations if designation.strip()))
+
+    result = parsed_lists[0]
+    for other in parsed_lists[1:]:
+        result = coalesce_designations(combine(result, other))
+    return "\n".join(map(format_designation, result))
+
+
+@anvil.server.callable()
+def designation_union(*designation_lists):
+    # Lines designated in any of the lists
+    return combine_designation_lists(designation_lists, lambda a, b: a + b)
+
+
+@anvil.server.callable()
+def designation_intersection(*designation_lists):
+    # Lines designated in every list, e.g. where our ranges overlap theirs
+    return combine_designation_lists(designation_lists, intersect_designations)
+
+
+@anvil.server.callable()
+def designation_difference(*designation_lists):
+    # Lines in the first list that none of the others designate, e.g. what they designated that we didn't
+    return combine_designation_lists(designation_lists, subtract_designations)
+
+
+@anvil.server.callable()
+def designation_symmetric_difference(*designation_lists):
+    # Lines designated in an odd number of the lists (for two lists: in one but not the other)
+    return combine_designation_lists(designation_lists,
+                                     lambda a, b: subtract_designations(a, b) + subtract_designations(b, a))
 
 
-anvil.server.wait_forever()
+if __name__ == "__main__":
+    connect_uplink()
+    anvil.server.wait_forever()
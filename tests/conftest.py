@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Run everything inline and keep caches in memory, importing app does not connect the uplink
+os.environ.setdefault("WORKER_POOL_SIZE", "0")
+os.environ.setdefault("RESULT_CACHE_DIR", "")
+os.environ.setdefault("TRANSCRIPT_INDEX_DIR", tempfile.mkdtemp())  # Index files from earlier runs are never reused
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
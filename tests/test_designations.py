@@ -0,0 +1,39 @@
+import time
+
+import app
+
+
+OURS = ["12:3-9", "12:20-13:4", "15:1-5"]
+THEIRS = "12:7-14\n13:2-8\n15:6-10"
+
+
+def test_union_merges_overlapping_and_touching_ranges():
+    assert app.designation_union(OURS, THEIRS).split("\n") == ["12:3-14", "12:20-13:8", "15:1-10"]
+
+
+def test_union_merges_the_last_line_of_a_page_into_line_1_of_the_next():
+    assert app.designation_union(["12:20-25"], ["13:1-4"]) == "12:20-13:4"
+
+
+def test_intersection_keeps_lines_in_every_list():
+    assert app.designation_intersection(OURS, THEIRS).split("\n") == ["12:7-9", "13:2-4"]
+    assert app.designation_intersection(["12:20-25"], ["13:1-4"]) == ""
+
+
+def test_difference_cuts_cross_page_ranges_at_page_boundaries():
+    assert app.designation_difference(OURS, THEIRS).split("\n") == ["12:3-6", "12:20-13:1", "15:1-5"]
+    assert app.designation_difference(["12:1-14:10"], ["13:1-25"]).split("\n") == ["12:1-25", "14:1-10"]
+
+
+def test_symmetric_difference_keeps_lines_in_an_odd_number_of_lists():
+    assert app.designation_symmetric_difference(OURS, THEIRS).split("\n") == \
+        ["12:3-6", "12:10-14", "12:20-13:1", "13:5-8", "15:1-10"]
+    assert app.designation_symmetric_difference(["1:1-5"], ["1:3-7"], ["1:5-9"]).split("\n") == \
+        ["1:1-2", "1:5-5", "1:8-9"]
+
+
+def test_set_operations_do_not_depend_on_the_span_of_a_range():
+    start = time.perf_counter()
+    assert app.designation_union(["1:1-999999999:1"], ["1:1-2"]) == "1:1-999999999:1"
+    assert app.designation_difference(["1:1-999999999"], ["1:5-6"]).split("\n") == ["1:1-4", "1:7-999999999"]
+    assert time.perf_counter() - start < 1.0
@@ -0,0 +1,54 @@
+import threading
+
+import anvil
+import fitz
+import pytest
+
+import app
+
+
+def test_pdf_jobs_past_the_queue_limit_are_rejected(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app, "run_pdf_job", lambda *args: release.wait(5))
+    monkeypatch.setattr(app, "job_slots", threading.BoundedSemaphore(2))
+    media = anvil.BlobMedia("application/pdf", b"%PDF-1.4", name="transcript.pdf")
+
+    app.submit_pdf_job(media)
+    app.submit_pdf_job(media)
+    with pytest.raises(app.WorkerPoolBusyError):
+        app.submit_pdf_job(media)
+
+    # A finished job frees its slot
+    release.set()
+    assert app.job_slots.acquire(timeout=5)
+
+
+def highlighted_pdf(texts):
+    """ A PDF with one highlighted line per page, or a single blank page when texts is empty """
+    doc = fitz.open()
+    for text in texts:
+        page = doc.new_page()
+        page.insert_text((72, 72), text)
+        page.add_highlight_annot(page.search_for(text)[0])
+    if not texts:
+        doc.new_page()
+    return doc.tobytes()
+
+
+def run_job(pdf_bytes):
+    job_id = app.job_store.create("transcript.pdf")
+    app.run_pdf_job(job_id, pdf_bytes)
+    return app.job_store.get(job_id)
+
+
+def test_pdf_job_without_highlights_reports_zero_pages():
+    job = run_job(highlighted_pdf([]))
+    assert (job['state'], job['pages_done'], job['pages_total']) == ("done", 0, 0)
+
+
+def test_cached_pdf_job_reports_the_same_progress_as_the_first_run():
+    pdf_bytes = highlighted_pdf(["first excerpt", "second excerpt"])
+    first, cached = run_job(pdf_bytes), run_job(pdf_bytes)
+    assert (first['pages_done'], first['pages_total']) == (2, 2)
+    assert (cached['state'], cached['pages_done'], cached['pages_total'], cached['excerpts_ready']) == \
+        ("done", 2, 2, first['excerpts_ready'])
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import app
+
+
+SIZE = 200_000
+TIME_LIMIT = 2.0  # Seconds; linear passes over these inputs take a few milliseconds, quadratic ones minutes
+
+ADVERSARIAL_TEXTS = {
+    "whitespace_run": "1" + " " * SIZE + "x",
+    "trailing_whitespace_run": "1" + " \t" * SIZE + "\n2 Q. x",
+    "digit_run": "1" * SIZE + " x",
+    "digit_colons": "1:" * SIZE,
+    "timestamp_flood": "11:11:11 " * (SIZE // 9) + "x",
+    "timestamp_lines": "12:34:56\n" * (SIZE // 9),
+    "designation_flood": "12:3-4:5 " * (SIZE // 9),
+    "open_designations": "12:3-" * (SIZE // 5),
+    "no_newline_speakers": "1 Q. MR. SMITH: THE COURT: A. " * (SIZE // 30),
+    "page_headers": "Pg. 1" * (SIZE // 5),
+    "symbol_lines": "• ·\n" * (SIZE // 4),
+}
+
+
+def assert_fast(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    assert time.perf_counter() - start < TIME_LIMIT
+
+
+@pytest.mark.parametrize("text", ADVERSARIAL_TEXTS.values(), ids=ADVERSARIAL_TEXTS.keys())
+@pytest.mark.parametrize("pattern", [
+    app.TIMESTAMP_PATTERN,
+    app.LEADING_SYMBOL_PATTERN,
+    app.LINE_NUMBER_PREFIX_PATTERN,
+    app.RAW_LINE_NUMBER_PATTERN,
+    app.PAGE_HEADER_PATTERN,
+    app.DESIGNATION_TOKEN_PATTERN,
+    app.DESIGNATION_PATTERN,
+], ids=lambda pattern: pattern.pattern)
+def test_patterns_scan_adversarial_text_in_linear_time(pattern, text):
+    assert_fast(lambda: list(pattern.finditer(text)))
+
+
+@pytest.mark.parametrize("text", ADVERSARIAL_TEXTS.values(), ids=ADVERSARIAL_TEXTS.keys())
+def test_parse_transcript_handles_adversarial_text(text):
+    assert_fast(app.parse_transcript, text)
+
+
+@pytest.mark.parametrize("text", ADVERSARIAL_TEXTS.values(), ids=ADVERSARIAL_TEXTS.keys())
+def test_text_callables_handle_adversarial_text(text):
+    assert_fast(app.prepare_text_for_powerpoint, text, True, True, True, True, "Doe")
+    assert_fast(app.prepare_text_for_oncue, text)
+    assert_fast(app.resolve_designations, text, ["1:1-5", "12:3-4:5"])
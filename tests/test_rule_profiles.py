@@ -0,0 +1,73 @@
+import json
+import os
+
+import pytest
+
+import app
+
+
+def write_profiles(path, content, mtime):
+    path.write_text(content)
+    os.utime(path, (mtime, mtime))
+
+
+def test_invalid_profile_file_keeps_the_last_good_profiles(tmp_path):
+    path = tmp_path / "rule_profiles.json"
+    write_profiles(path, json.dumps({"veritext": {"qa_phrases": ["Q.", "A.", "Q, ", "A, "]}}), 1000)
+    registry = app.RuleProfileRegistry(str(path), 0)
+    profile = registry.get("veritext")
+
+    write_profiles(path, '{"veritext": {"qa_phrases": ["Q.", ', 2000)
+    assert registry.get("veritext") is profile
+    assert registry.get().name == "default"
+
+
+def test_invalid_profile_file_at_startup_falls_back_to_the_default_profile(tmp_path):
+    path = tmp_path / "rule_profiles.json"
+    write_profiles(path, "not json", 1000)
+    registry = app.RuleProfileRegistry(str(path), 0)
+    assert registry.get().name == "default"
+
+    write_profiles(path, json.dumps({"veritext": {}}), 2000)
+    assert registry.get("veritext").name == "veritext"
+
+
+def test_qa_phrases_that_are_neither_q_nor_a_are_rejected():
+    with pytest.raises(ValueError):
+        app.RuleProfile("arrows", {"qa_phrases": ["→ "]})
+
+
+def test_long_qa_phrases_are_rendered_as_the_whole_label(monkeypatch, tmp_path):
+    path = tmp_path / "rule_profiles.json"
+    write_profiles(path, json.dumps({"long": {"qa_phrases": ["QUESTION:", "ANSWER:"]}}), 1000)
+    monkeypatch.setattr(app, "rule_profiles", app.RuleProfileRegistry(str(path), 0))
+    text = "1 QUESTION: ok\n2 ANSWER: yes"
+    assert app.prepare_text_for_powerpoint(text, False, False, False, False, "", "long") == \
+        "QUESTION:\tok\nANSWER:\tyes"
+
+
+def test_models_parsed_with_other_rules_than_the_cache_key_are_not_cached(monkeypatch, tmp_path):
+    # The uplink still has the old profile file loaded while the worker already parses with the edited one
+    uplink_path, worker_path = tmp_path / "uplink.json", tmp_path / "worker.json"
+    write_profiles(uplink_path, json.dumps({"firm": {"qa_phrases": ["Q.", "A."]}}), 1000)
+    write_profiles(worker_path, json.dumps({"firm": {"qa_phrases": ["QUESTION:", "ANSWER:"]}}), 1000)
+    worker_profiles = app.RuleProfileRegistry(str(worker_path), 0)
+    parse_transcript = app.parse_transcript
+
+    def parse_on_worker(text, profile_name=None):
+        with monkeypatch.context() as worker:
+            worker.setattr(app, "rule_profiles", worker_profiles)
+            return parse_transcript(text, profile_name)
+
+    monkeypatch.setattr(app, "rule_profiles", app.RuleProfileRegistry(str(uplink_path), 0))
+    monkeypatch.setattr(app, "parse_transcript", parse_on_worker)
+    monkeypatch.setattr(app, "transcript_cache", app.ResultCache(8, "", 0))
+    text = "1 QUESTION: ok"
+    stale_handle = app.transcript_handle(text, "firm")
+
+    assert app.prepare_text_for_powerpoint(text, False, False, False, False, "", "firm") == "QUESTION:\tok"
+    assert app.prepare_text_for_powerpoint_batch([text], {"profile": "firm"}) == ["QUESTION:\tok"]
+    handle = app.load_text(text, "firm")
+    assert app.transcript_cache.get(stale_handle) is None
+    assert handle == app.transcript_handle(text, "firm", worker_profiles.get("firm").fingerprint) != stale_handle
+    assert app.render_text(handle, {}) == "QUESTION:\tok"
@@ -0,0 +1,82 @@
+import anvil
+import fitz
+import pytest
+
+import app
+
+
+HUGE_NUMBER = "99999999999999999999"  # Past the range of the model's integer columns
+DIGIT_RUN = "7" * 5000  # Past int()'s default digit limit
+
+OUT_OF_RANGE_TEXTS = [
+    f"{HUGE_NUMBER} Q. Where were you?\n2 A. At home.",
+    f"Pg. {HUGE_NUMBER}\n1 Q. Where were you?",
+    f"1:{HUGE_NUMBER}-3: 12:1-5:",
+    f"{HUGE_NUMBER}\nQ. Where were you?",
+    f"{DIGIT_RUN} Q. Where were you?\n{DIGIT_RUN}:1-2:",
+]
+
+
+@pytest.mark.parametrize("text", OUT_OF_RANGE_TEXTS)
+def test_out_of_range_numbers_are_treated_as_text(text):
+    app.prepare_text_for_powerpoint(text, True, True, True, True, "Doe")
+    app.prepare_text_for_oncue(text)
+    handle = app.load_text(text)
+    app.render_text(handle, {"detect_pages": True})
+    app.resolve_designations(text, ["12:1-5", f"1:1-{HUGE_NUMBER}"])
+
+
+def test_out_of_range_line_number_is_not_stripped_as_a_line_number():
+    model = app.parse_transcript(f"{HUGE_NUMBER} Q. Where were you?")
+    assert list(model.line_no) == [-1]
+
+
+def test_out_of_range_designation_tokens_are_ignored():
+    assert app.prepare_text_for_oncue(f"1:{HUGE_NUMBER}-3: 12:1-5:") == "12:1-5"
+
+
+def test_oncue_sorts_and_merges_designations():
+    text = "Pg. 12:1-5: x\n12:3-9: 12:20-25: 13:1-4:\n7:2-9: 12:20-13:4\n7:12-10:Q. 14:1-5:30 15:1-3:"
+    assert app.prepare_text_for_oncue(text).split("\n") == ["7:2-12", "12:1-9", "12:20-13:4", "14:1-5", "15:1-3"]
+
+
+def test_blank_numbered_lines_are_designation_lines():
+    handle = app.load_text("Pg. 12\n1 Q. Where were you?\n2 A. At home.\n3\n4 Q. Alone?")
+    assert app.get_excerpt(handle, "12:1-3") == "1 Q. Where were you?\n2 A. At home.\n3"
+    assert app.get_excerpt(handle, "12:3-4") == "3\n4 Q. Alone?"
+
+
+def test_transcript_index_files_are_evicted_by_size(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "TRANSCRIPT_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "TRANSCRIPT_INDEX_MAX_BYTES", 300)
+    handles = [app.load_text(f"Pg. {page}\n1 Q. Where were you?\n2 A. {'At home. ' * 10}") for page in (1, 2, 3)]
+    for page, handle in zip((1, 2, 3), handles):
+        app.get_excerpt(handle, f"{page}:1-2")
+
+    files = list(tmp_path.iterdir())
+    assert sum(path.stat().st_size for path in files) <= 300
+    assert len(files) == 2
+
+    # An evicted index is rebuilt from the loaded transcript
+    app.transcript_indexes._memory.clear()
+    assert app.get_excerpt(handles[0], "1:1-1") == "1 Q. Where were you?"
+
+
+def transcript_pdf(pages):
+    """ A PDF with one page per (header, [line texts]), line numbers in the left margin """
+    doc = fitz.open()
+    for header, lines in pages:
+        page = doc.new_page()
+        page.insert_text((500, 40), header)
+        for line_no, line in enumerate(lines, 1):
+            page.insert_text((30, 60 + 20 * line_no), str(line_no))
+            page.insert_text((100, 60 + 20 * line_no), line)
+    return doc.tobytes()
+
+
+def test_pdf_designations_use_printed_page_numbers():
+    pdf_bytes = transcript_pdf([("COVER", ["Deposition of Jane Doe"]),
+                                ("8", ["Q. Where were you?", "A. At home."])])
+    assert app.transcript_pdf_text(pdf_bytes) == "Pg. 8\n1 Q. Where were you?\n2 A. At home."
+    [result] = app.resolve_designations(anvil.BlobMedia("application/pdf", pdf_bytes, name="t.pdf"), ["8:1-2"])
+    assert result["text"] == "Q.\tWhere were you?\nA.\tAt home."
@@ -18,7 +18,7 @@ def extract_vector_objects(page):
 def extract_page_number(page):
     # Extract the first line of text on the page to get the page number
     first_line = page.get_text("text").split('\n')[0].strip()
-    match = re.search(r'\d+$', first_line)  # Match the last number in the line
+    match = re.search(r'(?<!\d)\d+$', first_line)  # Match the last number in the line
     if match:
         return int(match.group())
     return None
@@ -38,7 +38,7 @@ def extract_text_boxes(page):
                     line_text += span['text']
 
                 line_text_stripped = line_text.strip()
-                match = re.match(r'^\s*(\d+)\s*(Q\.|A\.)?\s*$', line_text_stripped)
+                match = re.match(r'^(\d+)\s*(Q\.|A\.)?$', line_text_stripped)
                 if match:
                     # If the line contains only a line number, optionally followed by "Q." or "A."
                     previous_line_number = match.group(1)